@@ -14,10 +14,16 @@ class Attention(Block):
         self.attentiongenerator = attentiongenerator
         self.attentionconsumer = attentionconsumer
 
-    def apply(self, criterion, data):
-        attention = self.attentiongenerator(criterion, data)
+    def apply(self, criterion, data, precomputed=None):
+        if precomputed is None:
+            attention = self.attentiongenerator(criterion, data)
+        else:
+            attention = self.attentiongenerator(criterion, data, precomputed)
         return self.attentionconsumer(data, attention)
 
+    def precompute(self, data):
+        return self.attentiongenerator.precompute(data)
+
 
 ############################## ATTENTION GENERATORS ###############################
 
@@ -58,6 +64,13 @@ class AttentionGenerator(Block):
     def apply(self, criterion, data):   # criterion: (batsize, indim), data: (batsize, seqlen, memdim)
         raise NotImplementedError("use subclass")
 
+    def precompute(self, data):
+        """
+        Criterion-independent part of apply(), to be computed once when the same data is attended to with many criteria.
+        Generators that support it take the result as an extra argument to apply(). Returns None if there is nothing to precompute.
+        """
+        return None
+
 
 class DotprodAttGen(AttentionGenerator):
     """
@@ -68,37 +81,51 @@ class DotprodAttGen(AttentionGenerator):
         return T.batched_dot(data, criterion)
 
 
-class LinearSumAttentionGenerator(AttentionGenerator):    # simple feedforward
+class LinearAttentionGenerator(AttentionGenerator):
+    """
+    Scores every data element with a linear transformation of the concatenation [data element, criterion].
+    The data and criterion halves of W are applied separately and combined by broadcasting over the sequence,
+    so all elements are scored at once without scanning.
+    """
     def __init__(self, **kw):
-        super(LinearSumAttentionGenerator, self).__init__(**kw)
+        super(LinearAttentionGenerator, self).__init__(**kw)
         self.W = param((self.indim, self.attdim), name="attention_ff").uniform()
 
-    def apply(self, criterion, data):   # data is (batsize, seqlen, elem_dim)
-        def rec(x_t, crit):     # x_t is (batsize, elem_dim), crit is (batsize, crit_dim)
-            ret = T.dot(T.concatenate([x_t, crit], axis=1), self.W)     # (batsize, innerdim)
-            return T.sum(ret, axis=1)       # (batsize, )
-        o, _ = T.scan(fn=rec, sequences=data.dimswap(1, 0), non_sequences=criterion)    # o is (seqlen, batsize)
-        return Softmax()(o.dimswap(1, 0))       # returns (batsize, seqlen), softmaxed on seqlen
+    def apply(self, criterion, data, dataproj=None):   # criterion: (batsize, crit_dim), data: (batsize, seqlen, datadim)
+        dataproj = self._project_data(data) if dataproj is None else dataproj
+        return self._score(dataproj, self._project_crit(criterion, data.shape[2]))
+
+    def precompute(self, data):
+        return self._project_data(data)
+
+    def _project_data(self, data):      # data: (batsize, seqlen, datadim) ==> (batsize, seqlen, attdim)
+        return T.tensordot(data, self.W[:data.shape[2], :], axes=[[2], [0]])
 
+    def _project_crit(self, criterion, datadim):   # criterion: (batsize, crit_dim) ==> (batsize, attdim)
+        return T.dot(criterion, self.W[datadim:, :])
 
-class LinearGateAttentionGenerator(AttentionGenerator):
+    def _combine(self, dataproj, critproj):     # ==> (batsize, seqlen, attdim)
+        return dataproj + critproj.dimshuffle(0, "x", 1)
+
+    def _score(self, dataproj, critproj):
+        raise NotImplementedError("use subclass")
+
+
+class LinearSumAttentionGenerator(LinearAttentionGenerator):    # simple feedforward
+    def _score(self, dataproj, critproj):
+        o = T.sum(self._combine(dataproj, critproj), axis=2)    # (batsize, seqlen)
+        return Softmax()(o)       # returns (batsize, seqlen), softmaxed on seqlen
+
+
+class LinearGateAttentionGenerator(LinearAttentionGenerator):
     def __init__(self, **kw):
         super(LinearGateAttentionGenerator, self).__init__(**kw)
-        self.W = param((self.indim, self.attdim), name="attention_ff").uniform()
         self.U = param((self.attdim,), name="attention_agg").uniform()
 
-    def apply(self, criterion, data):   # criterion: (batsize, crit_dim), data: (batsize, seqlen, datadim)
-        def rec(x_t, crit):
-            combo = self._get_combo(x_t, crit)  # (batsize, crit_dim + datadim)
-            trans = T.dot(combo, self.W)        # (batsize, innerdim)
-            trans = T.tanh(trans)                                       # apply tanh
-            ret = T.dot(trans, self.U)                                  # (batsize, )
-            return T.nnet.sigmoid(ret)                                  # apply sigmoid
-        o, _ = T.scan(fn=rec, sequences=data.dimswap(1, 0), non_sequences=criterion)
-        return o.dimswap(1, 0)
-
-    def _get_combo(self, x_t, crit):
-        return T.concatenate([x_t, crit], axis=1)
+    def _score(self, dataproj, critproj):
+        trans = T.tanh(self._combine(dataproj, critproj))     # (batsize, seqlen, attdim), apply tanh
+        ret = T.dot(trans, self.U)                              # (batsize, seqlen)
+        return T.nnet.sigmoid(ret)                              # apply sigmoid
 
 
 ################################ ATTENTION CONSUMERS #####################################
@@ -117,12 +144,8 @@ class AttentionConsumer(Block):
 
 
 class WeightedSumAttCon(AttentionConsumer):    # applies attention to sequence while summing up
-    def apply(self, data, weights):   # data: (batsize, seqlen, elem_dim)
-        def rec(x_t, att_t, acc):       # x_t: (batsize, elem_dim), att_t: (batsize, ), acc: (batsize, elem_dim)
-            acc += T.batched_dot(x_t, att_t)
-            return acc  # (batsize, elem_dim)
-        o, _ = T.scan(fn=rec, sequences=[data.dimswap(1, 0), weights.T], outputs_info=T.zeros((data.shape[0], data.shape[2])))
-        return o[-1, :, :]
+    def apply(self, data, weights):   # data: (batsize, seqlen, elem_dim), weights: (batsize, seqlen)
+        return T.batched_dot(weights, data)     # contracts seqlen for every example ==> (batsize, elem_dim)
 
 
 class ArgmaxAttCon(AttentionConsumer):
@@ -2,6 +2,9 @@ from teafacto.blocks.basic import VectorEmbed, Softmax, Embedder
 from teafacto.core.base import tensorops as T
 from teafacto.core.base import Block, Val, Var, param
 from teafacto.util import issequence
+import numpy as np
+import theano
+from theano import tensor
 
 
 class MemoryBlock(Embedder):
@@ -26,7 +29,8 @@ class MemoryBlock(Embedder):
         self.data = ourdata
         super(MemoryBlock, self).__init__(indim, outdim, **kw)      # outdim = outdim of the contained block
         self.payload = block
-        self.innervar = self.payload(*self.data) if None not in data else None    # innervar: (indim, outdim)
+        self.innervar = self.payload(*self.data) if all([datae is not None for datae in data]) else None    # innervar: (indim, outdim)
+        self._cache = None
 
     def apply(self, idxs, *datavar):     # idxs: ints of (batsize,)
         datavars = list(datavar)
@@ -44,41 +48,137 @@ class MemoryBlock(Embedder):
             assert(len(datavar) == 0)
         return self.innervar[idxs, :]
 
+    @property
+    def cached(self):
+        """
+        Replaces the memory encodings in the graph by a precomputed table (a shared buffer), computed right away.
+        The table goes stale when the payload changes and is recomputed by refresh(),
+        e.g. every N training batches with ModelTrainer.batchhook(memblock.refresh, inter=N).
+        Gradients do not flow into the payload through a cached memory.
+        """
+        assert(self.innervar is not None)   # all data must be provided during construction
+        if self._cache is None:
+            self._freshvar = self.innervar
+            self._refreshf = theano.function(inputs=[], outputs=self._freshvar.d)
+            self._cache = Val(self._refreshf())
+            self.innervar = self._cache
+        return self
+
+    @property
+    def uncached(self):
+        if self._cache is not None:
+            self.innervar = self._freshvar
+            self._cache = None
+        return self
+
+    def refresh(self):      # recomputes the cached memory encodings with the current payload parameters
+        assert(self._cache is not None)
+        self._cache.d.set_value(self._refreshf())
+
+    def rows(self, idxs):   # encodings of the given memory rows, applies the payload only to the data of those rows
+        if self._cache is not None:
+            return self.innervar[idxs, :]
+        assert(all([datae is not None for datae in self.data]))
+        return self.payload(*[datae[idxs] for datae in self.data])
+
 
 class MemoryAddress(Block):
+    _numneg = None      # number of sampled negatives, None addresses the full memory
+    _samplenumneg = None    # sampling settings, kept while addressing the full memory
+    _cands = None       # sampled candidate rows
+
     def __init__(self, memblock, **kw):
         super(MemoryAddress, self).__init__(**kw)
         self.memblock = memblock    # (mem_size, mem_dim)
 
     def apply(self, criterion):     # gets a criterion vector (batsize, crit_dim), outputs (batsize, mem_size)
+        if self._numneg is None:
+            return self._address(criterion, self.memblock.innervar)
+        else:                       # outputs (batsize, numcands)
+            return self._address(criterion, self.memblock.rows(self._cands)) - self._candlogq
+
+    def _address(self, criterion, mem):     # criterion: (batsize, crit_dim), mem: (numrows, mem_dim), out: (batsize, numrows)
         raise NotImplementedError("use subclass")
 
+    def sampled(self, numneg=None, freqs=None):
+        """
+        Training mode in which every batch is addressed against a sample of the memory only:
+        the gold rows passed to sample() and numneg negatives drawn with replacement, uniformly or proportional to freqs.
+        Outputs scores for the sampled candidates only, (batsize, numcands), corrected by the log of the expected
+        number of draws of their row. Gold memory idxs are mapped to candidate positions by goldpos().
+        Without arguments, switches back to the previous sampling settings.
+        Use with ModelTrainer.sampled(memaddr), which calls sample() before every training batch
+        and validates with full addressing.
+        """
+        if numneg is None:
+            assert(self._samplenumneg is not None)     # sampled before
+            self._numneg = self._samplenumneg
+            return self
+        memsize = int(self.memblock.indim)
+        self._numneg = self._samplenumneg = numneg
+        self._sampleprobs = np.ones((memsize,)) / memsize if freqs is None else np.asarray(freqs) * 1. / np.sum(freqs)
+        self._cands = Val(np.zeros((0,), dtype="int64"), name="memaddr_cands")
+        self._candlogq = Val(np.zeros((0,)), name="memaddr_candlogq")
+        return self
+
+    @property
+    def full(self):     # back to addressing the full memory, e.g. for evaluation
+        self._numneg = None
+        return self
+
+    @property
+    def issampled(self):
+        return self._numneg is not None
+
+    def sample(self, gold, rng=np.random):     # gold: memory idxs of any shape
+        negs = rng.choice(self._sampleprobs.shape[0], self._samplenumneg, p=self._sampleprobs)
+        cands = np.unique(np.concatenate([np.asarray(gold).flatten(), negs]))
+        self._cands.d.set_value(cands.astype("int64"))
+        self._candlogq.d.set_value(np.log(self._samplenumneg * self._sampleprobs[cands]).astype(theano.config.floatX))
+
+    def goldpos(self, gold):    # symbolic: positions of gold memory idxs (any shape) in the sampled candidates
+        flatgold = gold.flatten()
+        pos = tensor.argmax(tensor.eq(flatgold.dimshuffle(0, "x"), self._cands.d.dimshuffle("x", 0)), axis=1)   # (numgold, numcands)
+        return pos.reshape(gold.shape)
+
 
 class LinearGateMemAddr(MemoryAddress):
     """
-    Wraps a memory block
+    Wraps a memory block.
+    The memory and criterion halves of W are applied separately and combined by broadcasting.
+    If chunksize is given, the memory is scored chunksize rows at a time,
+    bounding the (batsize, rows, attdim) intermediate for large memories.
     """
-    def __init__(self, memblock, memdim=None, indim=None, attdim=None, **kw):
+    def __init__(self, memblock, memdim=None, indim=None, attdim=None, chunksize=None, **kw):
         assert (indim is not None and memdim is not None and attdim is not None)
+        self.memdim = memdim
+        self.chunksize = chunksize
         indim = memdim + indim
         innerdim = attdim
         super(LinearGateMemAddr, self).__init__(memblock, **kw)
         self.W = param((indim, innerdim), name="attention_ff").uniform()
         self.U = param((innerdim,), name="attention_agg").uniform()
 
-    def apply(self, criterion):     # criterion: (batsize, crit_dim), self.mem: (mem_size, mem_dim), out: (batsize, mem_size)
-        def rec(x_t, crit):                     # x_t: (mem_dim),   crit: (batsize, crit_dim)
-            combo = self._get_combo(x_t, crit)  # (batsize, crit_dim + datadim)
-            trans = T.dot(combo, self.W)        # (batsize, outdim)
-            trans = T.tanh(trans)                                       # apply tanh
-            ret = T.dot(trans, self.U)                                  # (batsize, )
-            return ret
-        o, _ = T.scan(fn=rec, sequences=self.memblock.innervar, non_sequences=criterion)    # (memsize, batsize)
-        return o.dimswap(1, 0)                                                              # (batsize, memsize)
+    def _address(self, criterion, mem):     # criterion: (batsize, crit_dim), mem: (mem_size, mem_dim), out: (batsize, mem_size)
+        memproj = T.dot(mem, self.W[:self.memdim, :])                        # (mem_size, attdim)
+        critproj = T.dot(criterion, self.W[self.memdim:, :])                # (batsize, attdim)
+        if self.chunksize is None:
+            return self._score(memproj, critproj)
+        else:
+            return self._chunkedscore(memproj, critproj)
+
+    def _score(self, memproj, critproj):    # memproj: (mem_size, attdim), critproj: (batsize, attdim), out: (batsize, mem_size)
+        trans = T.tanh(critproj.dimshuffle(0, "x", 1) + memproj.dimshuffle("x", 0, 1))     # (batsize, mem_size, attdim)
+        return T.dot(trans, self.U)
 
-    def _get_combo(self, x_t, crit):    # x_t: (mem_dim),   crit: (batsize, crit_dim), out: (batsize, mem_dim + crit_dim)
-        x_t_repped = T.repeat(x_t.reshape((x_t.shape[0], 1)), crit.shape[0], axis=1).T    # (batsize, mem_dim)
-        return T.concatenate([x_t_repped, crit], axis=1)
+    def _chunkedscore(self, memproj, critproj):
+        memsize = memproj.shape[0]
+        numchunks = (memsize + self.chunksize - 1) // self.chunksize
+        padding = T.zeros((numchunks * self.chunksize - memsize, memproj.shape[1]))    # last chunk padded with zero rows
+        chunks = T.concatenate([memproj, padding], axis=0).reshape((numchunks, self.chunksize, memproj.shape[1]))
+        o, _ = T.scan(fn=self._score, sequences=chunks, non_sequences=critproj)     # (numchunks, batsize, chunksize)
+        o = o.dimswap(1, 0).reshape((critproj.shape[0], numchunks * self.chunksize))
+        return o[:, :memsize]                                                       # (batsize, mem_size)
 
 
 class TransDotMemAddr(MemoryAddress):
@@ -87,8 +187,8 @@ class TransDotMemAddr(MemoryAddress):
         self.W = param((memdim, attdim), name="addr_memtrans").uniform()
         self.U = param((indim, attdim), name="addr_crittrans").uniform()
 
-    def apply(self, criterion):
-        wmem = T.dot(self.memblock.innervar, self.W)
+    def _address(self, criterion, mem):
+        wmem = T.dot(mem, self.W)
         ucrit = T.dot(criterion, self.U)
         return T.dot(ucrit, wmem.T)
 
@@ -99,8 +199,8 @@ class GeneralDotMemAddr(MemoryAddress):
         super(GeneralDotMemAddr, self).__init__(memblock, **kw)
         self.W = param((memdim, indim), name="addressing").uniform()
 
-    def apply(self, criterion):     # criterion: (batsize, indim), self.mem: (mem_size, mem_dim), out: (batsize, mem_size)
-        memdot = T.dot(self.memblock.innervar, self.W)  # (mem_size, indim)
+    def _address(self, criterion, mem):     # criterion: (batsize, indim), mem: (mem_size, mem_dim), out: (batsize, mem_size)
+        memdot = T.dot(mem, self.W)  # (mem_size, indim)
         '''def rec(x_t, crit):         # x_t: (indim),   crit: (batsize, indim)
             d = T.dot(crit, x_t)    # (batsize, )
             return T.nnet.sigmoid(d)
@@ -114,5 +214,5 @@ class DotMemAddr(MemoryAddress):
     def __init__(self, memblock, memdim=None, indim=None, attdim=None, **kw):
         super(DotMemAddr, self).__init__(memblock, **kw)
 
-    def apply(self, criterion): # (batsize, encdim), memblock.var:: (memsize, encdim)
-        return T.dot(criterion, self.memblock.innervar.T)
+    def _address(self, criterion, mem): # (batsize, encdim), mem: (memsize, encdim)
+        return T.dot(criterion, mem.T)
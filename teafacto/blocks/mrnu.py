@@ -5,6 +5,13 @@ from teafacto.util import issequence
 
 
 class XLTM(GatedRNU):
+    inpparamnames = [("wma", "bma"), ("wma2", "bma2"), ("wsf", "bsf"), ("wmf", "bmf"),
+                     ("wif", "bif"), ("wug", "bug"), ("wwf", "bwf")]
+    recparamnames = [("uma", "uma2", "usf", "umf", "uif", "uug", "uwf"),     # on previous state
+                     ("mma", "mma2"),                                       # on previous memory content
+                     ("msf", "mmf", "mif", "mug", "mwf")]                   # on current memory content
+    _keepinp = True
+
     def __init__(self, discrete=True, memsize=50, **kw):
         self._waitforit = True
         super(XLTM, self).__init__(**kw)
@@ -51,19 +58,26 @@ class XLTM(GatedRNU):
         :param mem_tm1: previous memory state: (batsize, mem_size, state_dim)
         :return:    (y_t, h_t, m_t, mem_t)
         """
+        return self.prerec(self.preproject(x_t), m_tm1, mem_tm1, h_tm1)
+
+    def prerec(self, p_t, m_tm1, mem_tm1, h_tm1):
+        x_t, xma, xma2, xsf, xmf, xif, xug, xwf = self.splitprojected(p_t)
+        hma, hma2, hsf, hmf, hif, hug, hwf = self.recdots(h_tm1, self.recparamnames[0])
+        mma, mma2 = self.recdots(m_tm1, self.recparamnames[1])
         # read memory
-        memory_addr_gate1 =     self.gateactivation(T.dot(h_tm1, self.uma) + T.dot(x_t, self.wma) + T.dot(m_tm1, self.mma) + self.bma)
-        memory_addr_gate2 =     self.gateactivation(T.dot(h_tm1, self.uma2) + T.dot(x_t, self.wma2) + T.dot(m_tm1, self.mma2) + self.bma2)
+        memory_addr_gate1 =     self.gateactivation(hma + xma + mma)
+        memory_addr_gate2 =     self.gateactivation(hma2 + xma2 + mma2)
         memaddrcan         =    memory_addr_gate1 * h_tm1 +      (1 - memory_addr_gate1) * m_tm1
         memaddr =               memory_addr_gate2 * memaddrcan + (1 - memory_addr_gate2) * x_t      # TODO: ERROR HERE: x_t shape incompatible with internal shapes
         memsel = self.attgen(memaddr, mem_tm1)
         m_t = self.attcon(mem_tm1, memsel)
 
         # update inner stuff
-        state_filter_gate =     self.gateactivation(T.dot(h_tm1, self.usf) + T.dot(x_t, self.wsf) + T.dot(m_t, self.msf) + self.bsf)
-        memory_filter_gate =    self.gateactivation(T.dot(h_tm1, self.umf) + T.dot(x_t, self.wmf) + T.dot(m_t, self.mmf) + self.bmf)
-        input_filter_gate =     self.gateactivation(T.dot(h_tm1, self.uif) + T.dot(x_t, self.wif) + T.dot(m_t, self.mif) + self.bif)
-        update_gate     =       self.gateactivation(T.dot(h_tm1, self.uug) + T.dot(x_t, self.wug) + T.dot(m_t, self.mug) + self.bug)
+        msf, mmf, mif, mug, mwf = self.recdots(m_t, self.recparamnames[2])
+        state_filter_gate =     self.gateactivation(hsf + xsf + msf)
+        memory_filter_gate =    self.gateactivation(hmf + xmf + mmf)
+        input_filter_gate =     self.gateactivation(hif + xif + mif)
+        update_gate     =       self.gateactivation(hug + xug + mug)
 
         # compute new state
         h_tm1_filtered = T.dot(state_filter_gate * h_tm1, self.u)
@@ -73,7 +87,7 @@ class XLTM(GatedRNU):
         h_t = update_gate * h_tm1 + (1 - update_gate) * h_t_can
 
         # write memory
-        memory_write_filter=    self.gateactivation(T.dot(h_tm1, self.uwf) + T.dot(x_t, self.wwf) + T.dot(m_t, self.mwf) + self.bwf)    # (batsize, state_dim)
+        memory_write_filter=    self.gateactivation(hwf + xwf + mwf)    # (batsize, state_dim)
         if self.discrete:       # memsel: (batsize, mem_size)
             memseln = T.zeros_like(memsel)
             memsel = T.argmax(memsel, axis=1)
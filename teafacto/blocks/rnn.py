@@ -41,17 +41,50 @@ class ReccableStack(ReccableBlock):
             init_infos.extend(initinfo)
         return init_infos, initstates   # layerwise in reverse
 
+    _precompute = False
+
+    @property
+    def precompute(self):
+        '''Call this switch to apply the first layers and input projections on the whole sequence before scanning'''
+        self._precompute = True
+        return self
+
+    def _firstreccable(self):
+        i = 0
+        while i < len(self.layers) and not isinstance(self.layers[i], ReccableBlock):
+            i += 1
+        return i
+
+    def preproject(self, seq):      # seq: (seqlen, batsize, ...)
+        first = self._firstreccable()
+        if first > 0:                   # non-recurrent layers under the first recurrent one
+            seq = timedistribute(seq, *self.layers[:first])
+        if first < len(self.layers):
+            seq = self.layers[first].preproject(seq)
+        return seq
+
+    def prerec(self, p_t, *states):
+        return self._rec(self.layers[self._firstreccable():], p_t, states, pre=True)
+
     def rec(self, x_t, *states):
+        return self._rec(self.layers, x_t, states)
+
+    @classmethod
+    def _rec(cls, layers, x_t, states, pre=False):
         # apply each block on x_t to get next-level input, consume states in the process
         nextinp = x_t
         nextstates = []
-        for block in self.layers:
+        for block in layers:
             if isinstance(block, ReccableBlock):
                 numstates = len(inspect.getargspec(block.rec).args) - 2
                 # eat from behind
                 recstates = states[-numstates:]
                 states = states[:-numstates]
-                rnuret = block.rec(nextinp, *recstates)
+                if pre:     # only the first recurrent layer gets precomputed input
+                    rnuret = block.prerec(nextinp, *recstates)
+                    pre = False
+                else:
+                    rnuret = block.rec(nextinp, *recstates)
                 # insert from behind
                 i = 0
                 for nextstate in rnuret[1:]:
@@ -65,13 +98,24 @@ class ReccableStack(ReccableBlock):
     def apply(self, se, initstates=None):
         seq = se.dimswap(1, 0)
         initstatearg = initstates if initstates is not None else seq.shape[1]
-        outputs, _ = T.scan(fn=self.rec,
+        if self._precompute:
+            seq = self.preproject(seq)
+        outputs, _ = T.scan(fn=self.prerec if self._precompute else self.rec,
                             sequences=seq,
                             outputs_info=[None]+self.get_init_info(initstatearg))
         output = outputs[0]
         return output.dimswap(1, 0)
 
 
+def timedistribute(seq, *blocks):  # applies non-recurrent blocks on every element of seq: (seqlen, batsize, ...) at once
+    flatshape = [seq.shape[0] * seq.shape[1]] + [seq.shape[i] for i in range(2, seq.d.ndim)]
+    ret = seq.reshape(flatshape, ndim=seq.d.ndim - 1)       # (seqlen*batsize, ...)
+    for block in blocks:
+        ret = block(ret)
+    retshape = [seq.shape[0], seq.shape[1]] + [ret.shape[i] for i in range(1, ret.d.ndim)]
+    return ret.reshape(retshape, ndim=ret.d.ndim + 1)
+
+
 class RecurrentStack(Block):       # TODO: setting init states of contained recurrent blocks
     def __init__(self, *layers, **kw):
         super(RecurrentStack, self).__init__(**kw)
@@ -79,13 +123,22 @@ class RecurrentStack(Block):       # TODO: setting init states of contained recu
 
     def apply(self, seq):   # layer-wise processing of input sequence
         acc = seq
+        distributed = []    # consecutive non-recurrent layers, applied on all time steps at once
         for layer in self.layers:
+            if isinstance(layer, Block) and not isinstance(layer, RecurrentBlock) and not layer._stepwise:
+                distributed.append(layer)
+                continue
+            if len(distributed) > 0:
+                acc = timedistribute(acc, *distributed)
+                distributed = []
             if isinstance(layer, RecurrentBlock):
                 acc = layer(acc)
-            elif isinstance(layer, Block): # non-recurrent ==> recur
+            elif isinstance(layer, Block): # non-recurrent that must be applied per time step ==> recur
                 acc = self.recurnonreclayer(acc, layer)
             else:
                 raise Exception("can not apply this layer: " + str(layer))
+        if len(distributed) > 0:
+            acc = timedistribute(acc, *distributed)
         return acc
 
     @classmethod
@@ -172,11 +225,18 @@ class SeqEncoder(ReccableBlockParameterized, AttentionConsumer, Block):
     _all_states = False
     _weighted = False
     _nomask = False
+    _precompute = False
 
     @property
     def nomask(self):
         self._nomask = True
 
+    @property
+    def precompute(self):
+        '''Call this switch to compute the input projections of the first recurrent layer before scanning'''
+        self._precompute = True
+        return self
+
     def apply(self, seq, weights=None): # seq: (batsize, seqlen, dim), weights: (batsize, seqlen)
         inp = seq.dimswap(1, 0)         # inp: (seqlen, batsize, dim)
         if weights is None:
@@ -184,8 +244,11 @@ class SeqEncoder(ReccableBlockParameterized, AttentionConsumer, Block):
         else:
             self._weighted = True
             w = weights.dimswap(1, 0)
+        mask = self._get_mask(inp)      # (seqlen, batsize)
+        if self._precompute:
+            inp = self.block.preproject(inp)
         outputs, _ = T.scan(fn=self.recwrap,
-                            sequences=[inp, w],
+                            sequences=[inp, w, mask],
                             outputs_info=[None]+self.block.get_init_info(seq.shape[0]),
                             go_backwards=self._reverse)
         return self._get_apply_outputs(outputs)
@@ -213,13 +276,19 @@ class SeqEncoder(ReccableBlockParameterized, AttentionConsumer, Block):
             output = res
         return output
 
-    def recwrap(self, x_t, w_t, *args): # x_t: (batsize, dim)      if input is all zeros, just return previous state
-        if not self._nomask:
-            if x_t.ndim == 1:       # ==> indexes
-                mask = x_t > 0      # 0 is TERMINUS
-            else:
-                mask = x_t.norm(2, axis=1) > 0 # mask: (batsize, )
-        rnuret = self.block.rec(x_t, *args) # list of matrices (batsize, **somedims**)
+    def _get_mask(self, inp):           # inp: (seqlen, batsize, ...)       if input is all zeros, just return previous state
+        if self._nomask:
+            return T.ones((inp.shape[0], inp.shape[1]))
+        if inp.d.ndim == 2:     # ==> indexes
+            return inp > 0      # 0 is TERMINUS
+        else:
+            return inp.norm(2, axis=2) > 0  # mask: (seqlen, batsize)
+
+    def recwrap(self, x_t, w_t, mask, *args): # x_t: (batsize, dim), mask: (batsize, )
+        if self._precompute:
+            rnuret = self.block.prerec(x_t, *args)
+        else:
+            rnuret = self.block.rec(x_t, *args) # list of matrices (batsize, **somedims**)
         if self._weighted:
             rnuret = map(lambda (origarg, rnuretarg): (origarg.T * (1 - w_t) + rnuretarg.T * w_t).T, zip([args[0]] + list(args), rnuret))
         if not self._nomask:
@@ -279,9 +348,16 @@ class SeqDecoder(ReccableBlockParameterized, Block):
             init_info = self.block.get_init_info(self.init_states)  # sets init states to provided ones
         else:
             init_info = self.block.get_init_info(seq.shape[0])           # initializes zero init states
-        outputs, _ = T.scan(fn=self.recwrap,
-                            sequences=sequences,
-                            outputs_info=[None, context, context_0, 0] + init_info)
+        ctxproj = self._precompute_ctx(context)
+        if ctxproj is None:
+            outputs, _ = T.scan(fn=self.recwrap,
+                                sequences=sequences,
+                                outputs_info=[None, context, context_0, 0] + init_info)
+        else:   # context-side attention computed once, passed as non-sequence
+            outputs, _ = T.scan(fn=lambda *args: self.recwrap(*args[:-1], ctxproj=args[-1]),
+                                sequences=sequences,
+                                outputs_info=[None, context, context_0, 0] + init_info,
+                                non_sequences=[ctxproj])
         return outputs[0].dimswap(1, 0)     # returns probabilities of symbols --> (batsize, seqlen, vocabsize)
 
     def _get_ctx_t0(self, ctx, ctx_0=None):
@@ -298,7 +374,12 @@ class SeqDecoder(ReccableBlockParameterized, Block):
                 print "sum ting wong in SeqDecoder _get_ctx_t0()"
         return ctx_0
 
-    def recwrap(self, x_t, ctx, ctx_tm1, t, *states_tm1):  # x_t: (batsize), context: (batsize, enc.innerdim)
+    def _precompute_ctx(self, ctx):     # only dynamic context is attended to
+        if self.attention is not None and ctx.d.ndim > 2:
+            return self.attention.precompute(ctx)
+        return None
+
+    def recwrap(self, x_t, ctx, ctx_tm1, t, *states_tm1, **kw):  # x_t: (batsize), context: (batsize, enc.innerdim)
         i_t = self.embedder(x_t)                             # i_t: (batsize, embdim)
         j_t = self._get_j_t(i_t, ctx_tm1)
         rnuret = self.block.rec(j_t, *states_tm1)     # list of matrices (batsize, **somedims**)
@@ -306,7 +387,7 @@ class SeqDecoder(ReccableBlockParameterized, Block):
         t = t + 1
         h_t = ret[0]
         states_t = ret[1:]
-        ctx_t = self._gen_context(ctx, h_t)
+        ctx_t = self._gen_context(ctx, h_t, kw.get("ctxproj"))
         g_t = self._get_g_t(h_t, ctx_t)
         y_t = self.softmaxoutblock(g_t)
         return [y_t, ctx, ctx_t, t] + states_t #, {}, T.until( (i > 1) * T.eq(mask.norm(1), 0) )
@@ -317,8 +398,8 @@ class SeqDecoder(ReccableBlockParameterized, Block):
     def _get_g_t(self, h_t, ctx_t):
         return T.concatenate([h_t, ctx_t], axis=1) if self.outconcat else h_t
 
-    def _gen_context(self, multicontext, criterion):
-        return self.attention(criterion, multicontext) if self.attention is not None else multicontext
+    def _gen_context(self, multicontext, criterion, ctxproj=None):
+        return self.attention(criterion, multicontext, ctxproj) if self.attention is not None else multicontext
 
 # ----------------------------------------------------------------------------------------------------------------------
 
@@ -1,6 +1,7 @@
-from teafacto.core.base import Block, param
+from teafacto.core.base import Block, param, Parameter
 from teafacto.core.base import tensorops as T
 from teafacto.util import issequence
+import numpy as np
 
 
 class RecurrentBlock(Block):     # ancestor class for everything that consumes sequences f32~(batsize, seqlen, ...)
@@ -24,6 +25,12 @@ class ReccableBlock(RecurrentBlock):    # exposes a rec function
     def rec(self, *args):
         raise NotImplementedError("use subclass")
 
+    def preproject(self, seq):      # seq: (seqlen, batsize, dim) ==> input for prerec(), computed for the whole sequence
+        return seq
+
+    def prerec(self, *args):        # same as rec() but takes as input a time step of what preproject() returned
+        return self.rec(*args)
+
     def get_init_info(self, initstates):
         info, red = self.do_get_init_info(initstates)
         assert((issequence(red) and len(red) == 0) or (not issequence(red)))
@@ -38,9 +45,14 @@ class ReccableBlock(RecurrentBlock):    # exposes a rec function
 
 class RNUBase(ReccableBlock):
     paramnames = []
+    inpparamnames = []      # (weight, bias) pairs of input projections that don't depend on the state
+    recparamnames = []      # groups of state matrices multiplied with the same state, can be fused into one param
     _waitforit = False
+    _keepinp = False        # whether prerec() also needs the raw input
+    _precompute = False
+    _fused = False
 
-    def __init__(self, dim=20, innerdim=20, wreg=0.0001, initmult=0.1, nobias=False, paraminit="uniform", **kw): # dim is input dimensions, innerdim = dimension of internal elements
+    def __init__(self, dim=20, innerdim=20, wreg=0.0001, initmult=0.1, nobias=False, paraminit="uniform", fused=False, **kw): # dim is input dimensions, innerdim = dimension of internal elements
         super(RNUBase, self).__init__(**kw)
         self.indim = dim
         self.innerdim = innerdim
@@ -48,6 +60,7 @@ class RNUBase(ReccableBlock):
         self.initmult = initmult
         self.nobias = nobias
         self.paraminit = paraminit
+        self._fused = fused
         self.rnuparams = {}
         if not self._waitforit:
             self.initparams()
@@ -74,6 +87,91 @@ class RNUBase(ReccableBlock):
                     shape = (self.innerdim, self.innerdim)
             self.rnuparams[paramname] = param(shape, name=paramname).init(self.paraminit)
             setattr(self, paramname, self.rnuparams[paramname])
+        if self._fused:
+            self._fused = False
+            self.fuse()
+
+    ############## FUSED STATE MATRICES ##############
+    @staticmethod
+    def fusedname(group):
+        return "_".join(group)
+
+    def fuse(self):     # replaces every group of state matrices by one concatenated param, keeping values
+        if self._fused:
+            return self
+        self.fusedsplits = {}
+        for group in self.recparamnames:
+            parts = [self.rnuparams[name] for name in group]
+            fusedname = self.fusedname(group)
+            fused = Parameter(np.concatenate([part.d.get_value() for part in parts], axis=1),
+                              name=fusedname, lrmul=parts[0].lrmul, regmul=parts[0].regmul)
+            fused.initializer = (lambda ps: lambda: np.concatenate([p.initializer() for p in ps], axis=1))(parts)
+            self.fusedsplits[fusedname] = [part.shape[1] for part in parts]
+            for name in group:
+                del self.rnuparams[name]
+                delattr(self, name)
+            self.rnuparams[fusedname] = fused
+            setattr(self, fusedname, fused)
+        self._fused = True
+        return self
+
+    def unfuse(self):   # splits fused params back into the separate state matrices, keeping values
+        if not self._fused:
+            return self
+        for group in self.recparamnames:
+            fusedname = self.fusedname(group)
+            fused = self.rnuparams[fusedname]
+            splits = self.fusedsplits[fusedname]
+            values = self._slicecols(fused.d.get_value(), splits)
+            for i, (name, value) in enumerate(zip(group, values)):
+                part = Parameter(value, name=name, lrmul=fused.lrmul, regmul=fused.regmul)
+                part.initializer = (lambda f, i: lambda: self._slicecols(f(), splits)[i])(fused.initializer, i)
+                self.rnuparams[name] = part
+                setattr(self, name, part)
+            del self.rnuparams[fusedname]
+            delattr(self, fusedname)
+        self.fusedsplits = {}
+        self._fused = False
+        return self
+
+    def recdots(self, h, group):    # dots of state h with every state matrix in group, in one dot if fused
+        if self._fused:
+            fusedname = self.fusedname(group)
+            return self._slicecols(T.dot(h, getattr(self, fusedname)), self.fusedsplits[fusedname])
+        else:
+            return [T.dot(h, getattr(self, name)) for name in group]
+
+    @staticmethod
+    def _slicecols(x, dims):        # splits last axis of matrix x into consecutive slices of given widths
+        ret = []
+        offset = 0
+        for dim in dims:
+            ret.append(x[:, offset:offset+dim])
+            offset += dim
+        return ret
+
+    @property
+    def precompute(self):
+        '''Call this switch to compute the input projections for the whole sequence before scanning'''
+        self._precompute = True
+        return self
+
+    def preproject(self, seq):      # seq: (..., indim) ==> (..., [indim +] sum of projection dims)
+        if len(self.inpparamnames) == 0:
+            return seq
+        ws = [getattr(self, w) for w, _ in self.inpparamnames]
+        ret = T.dot(seq, T.concatenate(ws, axis=1))     # one big dot for all input projections
+        if not self.nobias:
+            ret = ret + T.concatenate([getattr(self, b) for _, b in self.inpparamnames], axis=0)
+        if self._keepinp:
+            ret = T.concatenate([seq, ret], axis=seq.ndim - 1)
+        return ret
+
+    def splitprojected(self, p_t):  # p_t: (batsize, [indim +] sum of projection dims) ==> list of matrices
+        dims = [getattr(self, w).shape[1] for w, _ in self.inpparamnames]
+        if self._keepinp:
+            dims = [self.indim] + dims
+        return self._slicecols(p_t, dims)
 
     def apply(self, x, initstates=None):
         if initstates is None:
@@ -83,7 +181,9 @@ class RNUBase(ReccableBlock):
             assert(issequence(infoarg))
         inputs = x.dimswap(1, 0) # inputs is (seq_len, batsize, dim)
         init_info = self.get_init_info(infoarg)
-        outputs, _ = T.scan(fn=self.rec,
+        if self._precompute:
+            inputs = self.preproject(inputs)
+        outputs, _ = T.scan(fn=self.prerec if self._precompute else self.rec,
                             sequences=inputs,
                             outputs_info=[None]+init_info,
                             go_backwards=self._reverse)
@@ -93,6 +193,7 @@ class RNUBase(ReccableBlock):
 
 class RNU(RNUBase):
     paramnames = ["u", "w", "b"]
+    inpparamnames = [("w", "b")]
 
     def __init__(self, outpactivation=T.tanh, **kw):
         self.outpactivation = outpactivation
@@ -109,9 +210,11 @@ class RNU(RNUBase):
         return [outputs[0]]
 
     def rec(self, x_t, h_tm1):      # x_t: (batsize, dim), h_tm1: (batsize, innerdim)
-        inp = T.dot(x_t, self.w)    # w: (dim, innerdim) ==> inp: (batsize, innerdim)
+        return self.prerec(self.preproject(x_t), h_tm1)
+
+    def prerec(self, p_t, h_tm1):   # p_t: (batsize, innerdim), is x_t * w + b
         rep = T.dot(h_tm1, self.u)  # u: (innerdim, innerdim) ==> rep: (batsize, innerdim)
-        h = inp + rep + self.b               # h: (batsize, innerdim)
+        h = p_t + rep               # h: (batsize, innerdim)
         h = self.outpactivation(h)               #
         return [h, h] #T.tanh(inp+rep)
 
@@ -127,6 +230,8 @@ class GatedRNU(RNU):
 
 class GRU(GatedRNU):
     paramnames = ["um", "wm", "uhf", "whf", "u", "w", "bm", "bhf", "b"]
+    inpparamnames = [("wm", "bm"), ("whf", "bhf"), ("w", "b")]
+    recparamnames = [("um", "uhf")]
 
     def rec(self, x_t, h_tm1):
         '''
@@ -134,14 +239,23 @@ class GRU(GatedRNU):
         :param h_tm1: previous states (nb_samples, out_dim)
         :return: new state (nb_samples, out_dim)
         '''
-        mgate =  self.gateactivation(T.dot(h_tm1, self.um)  + T.dot(x_t, self.wm)  + self.bm)
-        hfgate = self.gateactivation(T.dot(h_tm1, self.uhf) + T.dot(x_t, self.whf) + self.bhf)
-        canh = self.outpactivation(T.dot(h_tm1 * hfgate, self.u) + T.dot(x_t, self.w) + self.b)
+        return self.prerec(self.preproject(x_t), h_tm1)
+
+    def prerec(self, p_t, h_tm1):
+        xm, xhf, x = self.splitprojected(p_t)
+        hm, hhf = self.recdots(h_tm1, ("um", "uhf"))
+        mgate =  self.gateactivation(hm  + xm)
+        hfgate = self.gateactivation(hhf + xhf)
+        canh = self.outpactivation(T.dot(h_tm1 * hfgate, self.u) + x)
         h = mgate * h_tm1 + (1-mgate) * canh
         return [h, h]
 
 
 class IFGRU(GatedRNU):      # input-modulating GRU
+    inpparamnames = [("wm", "bm"), ("whf", "bhf"), ("wif", "bif")]
+    recparamnames = [("um", "uhf", "uif")]
+    _keepinp = True
+
     def __init__(self, **kw):
         self._waitforit = True
         super(IFGRU, self).__init__(**kw)
@@ -156,9 +270,14 @@ class IFGRU(GatedRNU):      # input-modulating GRU
         :param h_tm1: previous states (nb_samples, out_dim)
         :return: new state (nb_samples, out_dim)
         '''
-        mgate =  self.gateactivation(T.dot(h_tm1, self.um)  + T.dot(x_t, self.wm)  + self.bm)
-        hfgate = self.gateactivation(T.dot(h_tm1, self.uhf) + T.dot(x_t, self.whf) + self.bhf)
-        ifgate = self.gateactivation(T.dot(h_tm1, self.uif) + T.dot(x_t, self.wif) + self.bif)
+        return self.prerec(self.preproject(x_t), h_tm1)
+
+    def prerec(self, p_t, h_tm1):
+        x_t, xm, xhf, xif = self.splitprojected(p_t)
+        hm, hhf, hif = self.recdots(h_tm1, ("um", "uhf", "uif"))
+        mgate =  self.gateactivation(hm  + xm)
+        hfgate = self.gateactivation(hhf + xhf)
+        ifgate = self.gateactivation(hif + xif)
         canh = self.outpactivation(T.dot(h_tm1 * hfgate, self.u) + T.dot(x_t * ifgate, self.w) + self.b)
         h = mgate * h_tm1 + (1-mgate) * canh
         return [h, h]
@@ -166,6 +285,8 @@ class IFGRU(GatedRNU):      # input-modulating GRU
 
 class LSTM(GatedRNU):
     paramnames = ["wf", "rf", "bf", "wi", "ri", "bi", "wo", "ro", "bo", "w", "r", "b", "pf", "pi", "po"]
+    inpparamnames = [("wf", "bf"), ("wi", "bi"), ("w", "b"), ("wo", "bo")]
+    recparamnames = [("rf", "ri", "r", "ro")]
 
     def do_get_init_info(self, initstates):
         if issequence(initstates):
@@ -183,12 +304,17 @@ class LSTM(GatedRNU):
         return [outputs[1]]
 
     def rec(self, x_t, y_tm1, c_tm1):
-        fgate = self.gateactivation(c_tm1*self.pf + self.bf + T.dot(x_t, self.wf) + T.dot(y_tm1, self.rf))
-        igate = self.gateactivation(c_tm1*self.pi + self.bi + T.dot(x_t, self.wi) + T.dot(y_tm1, self.ri))
+        return self.prerec(self.preproject(x_t), y_tm1, c_tm1)
+
+    def prerec(self, p_t, y_tm1, c_tm1):
+        xf, xi, x, xo = self.splitprojected(p_t)
+        yf, yi, y, yo = self.recdots(y_tm1, ("rf", "ri", "r", "ro"))
+        fgate = self.gateactivation(c_tm1*self.pf + xf + yf)
+        igate = self.gateactivation(c_tm1*self.pi + xi + yi)
         cf = c_tm1 * fgate
-        ifi = self.outpactivation(T.dot(x_t, self.w) + T.dot(y_tm1, self.r) + self.b) * igate
+        ifi = self.outpactivation(x + y) * igate
         c_t = cf + ifi
-        ogate = self.gateactivation(c_t*self.po + self.bo + T.dot(x_t, self.wo) + T.dot(y_tm1, self.ro))
+        ogate = self.gateactivation(c_t*self.po + xo + yo)
         y_t = ogate * self.outpactivation(c_t)
         return [y_t, y_t, c_t]
 
@@ -1,4 +1,5 @@
 from types import ModuleType
+from collections import OrderedDict
 
 import theano
 from lasagne.init import *
@@ -7,6 +8,8 @@ from theano import tensor
 from theano.tensor.var import _tensor_py_operators
 
 from teafacto.core.trainer import ModelTrainer
+from teafacto.core.fncache import fncache
+from teafacto.core.checkpoint import savecheckpoint, loadcheckpoint
 from teafacto.util import isstring, issequence, isfunction, Saveable, isnumber
 from teafacto.core.datafeed import DataFeed
 
@@ -176,16 +179,20 @@ class Parameter(TensorWrapped):
         return "param::'%s':%s%s" % (str(self.name), str(self.value.dtype), str(self.value.get_value().shape))
 
     ############## VALUE CONSTRAINTS ############### --> applied in the order that the were added
+    rowwiseconstraints = True   # whether all constraints can be applied to a subset of rows (for sparse updates)
+
     def clip(self, a, b):
         self.constraints.append(lambda x: tensor.clip(x, a, b))
         return self
 
     def normalize(self, axis=0, norm=2, epsilon=1e-7):
         self.constraints.append(lambda x: (x.T/(x.norm(norm, axis=axis)+epsilon)).T) # TODO
+        self.rowwiseconstraints = self.rowwiseconstraints and axis == 1
         return self
 
     def norm_constraint(self, max_norm, norm_axes=None, epsilon=1e-7):
         self.constraints.append(lambda x: norm_constraint(x, max_norm=max_norm, norm_axes=norm_axes, epsilon=epsilon))
+        self.rowwiseconstraints = False
         return self
 
     def constraintf(self):
@@ -359,6 +366,8 @@ def recurmap(fun, data):
         return type(data)(dict([(recurmap(fun, item[0]), recurmap(fun, item[1])) for item in data.items()]))
     elif isinstance(data, (tuple, list, set)):
         return type(data)([recurmap(fun, elem) for elem in data])
+    elif isinstance(data, slice):
+        return slice(recurmap(fun, data.start), recurmap(fun, data.stop), recurmap(fun, data.step))
     else:
         return fun(data)
 
@@ -368,6 +377,8 @@ class Probe(object):
 
 
 class Block(Elem, Saveable): # block with parameters
+    _stepwise = False   # whether block must be applied per time step when applied on sequences (see RecurrentStack)
+
     def __init__(self, **kw):
         super(Block, self).__init__(**kw)
         self.params = []
@@ -376,6 +387,12 @@ class Block(Elem, Saveable): # block with parameters
         self._predictf = None
         self._pristine = True
 
+    @property
+    def stepwise(self):
+        '''Call this switch to have this block scanned over sequences instead of applied on all elements at once'''
+        self._stepwise = True
+        return self
+
     def reset(self): # clear all non-param info in whole expression structure that ends in this block
         self.inputs = []
         self.output = None
@@ -392,7 +409,7 @@ class Block(Elem, Saveable): # block with parameters
         if self._predictf is None:
             #if False or len(self.inputs) == 0 or self.output is None:
             inps, outp = self.autobuild(*inputdata)
-            self._predictf = theano.function(outputs=outp.d, inputs=[x.d for x in inps])
+            self._predictf = fncache.function(outputs=outp.d, inputs=[x.d for x in inps])
         args = []
         for x in inputdata:
             if isinstance(x, DataFeed):
@@ -406,6 +423,49 @@ class Block(Elem, Saveable): # block with parameters
     def gettrainer(self, goldvar):
         return ModelTrainer(self, goldvar)
 
+    def savecheckpoint(self, path):     # parameter values only, as written by the trainer (see Saveable.save for whole blocks)
+        return savecheckpoint(path, self)
+
+    def loadcheckpoint(self, path):     # into this (already constructed) block, returns the config of the checkpoint
+        return loadcheckpoint(path, self)
+
+    @property
+    def namedparams(self):
+        '''
+        Parameters by attribute path (e.g. "enc.block.W"), walking the attributes of this block and its sub-blocks,
+        so every block built by the same code has the same names (used for checkpoints).
+        Parameters that are only found through the built output are named after the parameter.
+        '''
+        ret = OrderedDict()
+        seen = set()
+
+        def walk(obj, path):
+            if id(obj) in seen:
+                return
+            if isinstance(obj, Parameter):
+                seen.add(id(obj))
+                ret[path] = obj
+            elif isinstance(obj, Block):
+                seen.add(id(obj))
+                for k in sorted(obj.__dict__):
+                    if k not in ("output", "inputs", "parents", "_predictf"):
+                        walk(obj.__dict__[k], k if path == "" else "%s.%s" % (path, k))
+            elif isinstance(obj, (list, tuple)):
+                for i, elem in enumerate(obj):
+                    walk(elem, "%s.%d" % (path, i))
+            elif isinstance(obj, dict):
+                for k in sorted(obj):
+                    walk(obj[k], "%s.%s" % (path, k))
+        walk(self, "")
+        if self.output is not None:
+            for param in sorted(self.output.allparams, key=lambda p: p.name):
+                if id(param) not in seen:
+                    name = param.name
+                    while name in ret:
+                        name += "_"
+                    ret[name] = param
+        return ret
+
     # do not override ------------------------------------------------
     def wrapply(self, *args, **kwargs): # is this multi-output compatible?
         self.parents.extend(recurfilter(lambda x: isinstance(x, (Var, Val)), args))
@@ -0,0 +1,137 @@
+import json, os, shutil
+from collections import OrderedDict
+from Queue import Queue, Empty
+from threading import Thread
+
+import numpy as np
+
+
+# Checkpoints are directories with a manifest.json (format, model class, shapes and dtypes of the arrays, config),
+# the parameter values as params/<name>.npy and the optimizer state of every parameter as optim/<name>.<i>.npy.
+# Parameters are named by their attribute path in the model (Block.namedparams), so a checkpoint can be loaded into every model built by
+# the same code, without pickling the model. Arrays are memory-mapped when loaded.
+
+FORMAT = 1
+
+
+def checkpointarrays(model, optimstate=None):
+    '''
+    Copies of the values of the parameters of model and of their optimizer state (dict from Parameter to shared vars).
+    Returns the params (OrderedDict name ==> array) and optimizer state (OrderedDict name ==> list of arrays).
+    '''
+    optimstate = optimstate if optimstate is not None else {}
+    params, optim = OrderedDict(), OrderedDict()
+    for name, param in model.namedparams.items():
+        params[name] = param.d.get_value()
+        if param in optimstate:
+            optim[name] = [state.get_value() for state in optimstate[param]]
+    return params, optim
+
+
+def writecheckpoint(path, model, params, optim, config=None):
+    '''
+    Writes the arrays from checkpointarrays() to directory path, replacing an existing checkpoint only when done.
+    '''
+    manifest = {"format": FORMAT,
+                "model": "%s.%s" % (model.__class__.__module__, model.__class__.__name__),
+                "params": OrderedDict([(name, {"shape": list(value.shape), "dtype": str(value.dtype)})
+                                       for name, value in params.items()]),
+                "optim": OrderedDict([(name, len(states)) for name, states in optim.items()]),
+                "config": config if config is not None else {}}
+    tmppath = path + ".tmp"
+    if os.path.exists(tmppath):
+        shutil.rmtree(tmppath)
+    os.makedirs(os.path.join(tmppath, "params"))
+    os.makedirs(os.path.join(tmppath, "optim"))
+    for name, value in params.items():
+        np.save(os.path.join(tmppath, "params", name + ".npy"), value)
+    for name, states in optim.items():
+        for i, state in enumerate(states):
+            np.save(os.path.join(tmppath, "optim", "%s.%d.npy" % (name, i)), state)
+    with open(os.path.join(tmppath, "manifest.json"), "w") as f:
+        json.dump(manifest, f, indent=1)
+    if os.path.exists(path):
+        shutil.rmtree(path)
+    os.rename(tmppath, path)
+
+
+def savecheckpoint(path, model, optimstate=None, config=None):
+    params, optim = checkpointarrays(model, optimstate=optimstate)
+    writecheckpoint(path, model, params, optim, config=config)
+    return path
+
+
+def loadcheckpoint(path, model, optimstate=None):
+    '''
+    Sets the parameters of model (and their optimizer state, if given) to the values in the checkpoint at path.
+    Returns the config of the checkpoint.
+    '''
+    with open(os.path.join(path, "manifest.json")) as f:
+        manifest = json.load(f, object_pairs_hook=OrderedDict)
+    assert(manifest["format"] == FORMAT)
+    params = model.namedparams
+    if set(params.keys()) != set(manifest["params"].keys()):
+        raise Exception("checkpoint parameters %s do not match model parameters %s"
+                        % (sorted(manifest["params"].keys()), sorted(params.keys())))
+    optimstate = optimstate if optimstate is not None else {}
+    for name, param in params.items():
+        value = np.load(os.path.join(path, "params", name + ".npy"), mmap_mode="r")
+        if value.shape != param.d.get_value(borrow=True).shape:
+            raise Exception("shape of parameter %s is %s in checkpoint, %s in model"
+                            % (name, value.shape, param.d.get_value(borrow=True).shape))
+        param.d.set_value(value)
+        if param in optimstate and name in manifest["optim"]:
+            assert(manifest["optim"][name] == len(optimstate[param]))
+            for i, state in enumerate(optimstate[param]):
+                state.set_value(np.load(os.path.join(path, "optim", "%s.%d.npy" % (name, i)), mmap_mode="r"))
+    return manifest["config"]
+
+
+class CheckpointWriter(object):
+    '''
+    Writes checkpoints from a background thread. save() copies the values right away and returns,
+    a checkpoint that is still waiting to be written is replaced by a newer one. close() waits for the last one.
+    '''
+    def __init__(self):
+        self._queue = Queue(maxsize=1)
+        self._error = None
+        self._thread = None
+
+    def save(self, path, model, optimstate=None, config=None):
+        self._raise()
+        params, optim = checkpointarrays(model, optimstate=optimstate)
+        if self._thread is None:
+            self._thread = Thread(target=self._work)
+            self._thread.daemon = True
+            self._thread.start()
+        try:
+            self._queue.get_nowait()        # drop the older checkpoint that was not written yet
+            self._queue.task_done()
+        except Empty:
+            pass
+        self._queue.put((path, model, params, optim, config))
+
+    def _work(self):
+        while True:
+            item = self._queue.get()
+            try:
+                if item is None:
+                    return
+                writecheckpoint(*item)
+            except Exception as e:
+                self._error = e
+            finally:
+                self._queue.task_done()
+
+    def close(self):
+        if self._thread is not None:
+            self._queue.join()
+            self._queue.put(None)
+            self._thread.join()
+            self._thread = None
+        self._raise()
+
+    def _raise(self):
+        if self._error is not None:
+            e, self._error = self._error, None
+            raise e
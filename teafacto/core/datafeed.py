@@ -1,5 +1,9 @@
 import numpy as np
+import sys
+from copy import copy
 from math import ceil
+from Queue import Queue, Empty
+from threading import Thread, Event
 
 
 class DataFeeder(object): # contains data feeds
@@ -10,9 +14,14 @@ class DataFeeder(object): # contains data feeds
         assert(feedlens.count(feedlens[0]) == len(feedlens)) # all data feeds must have equal number of examples (axis zero)
         self.size = feedlens[0]
         self.random = True # or False or number
+        # own random stream (seeded from np.random) for shuffling and dynamic feeds,
+        # so batches do not depend on the thread that builds them (see PrefetchDataFeeder)
+        self._setrng(np.random.RandomState(np.random.randint(0, 2**31 - 1)))
         # iter state
         self.iteridxs = np.arange(self.size)
         self.offset = 0
+        self._bucketfeeds = None
+        self._seqlens = None
         self.reset()
         self.autoreset = True
         self._numbats = 1
@@ -21,18 +30,57 @@ class DataFeeder(object): # contains data feeds
     def numbats(self, numbats):
         self._numbats = numbats
         self.batsize = int(ceil(self.size*1./numbats))
+        if self._bucketfeeds is not None:
+            self.reset()
         return self
 
+    def bucketed(self, *feedidxs):
+        '''
+        Batches examples of similar length together and trims the feeds feedidxs (default: first feed) of every batch
+        along axis 1 to the longest sequence in the batch. All-zero positions at the end of a sequence are padding.
+        Examples of equal length and the order of the batches are still shuffled every epoch.
+        '''
+        self._bucketfeeds = feedidxs if len(feedidxs) > 0 else (0,)
+        self._seqlens = np.max([self.seqlens(self.feeds[i]) for i in self._bucketfeeds], axis=0)
+        self.reset()
+        return self
+
+    @staticmethod
+    def seqlens(feed, chunksize=10000):    # number of positions up to the last non-zero one along axis 1, per example
+        ret = np.zeros((feed.shape[0],), dtype="int32")
+        for start in range(0, feed.shape[0], chunksize):
+            x = np.asarray(feed[start:start+chunksize])
+            nonzero = (x != 0).reshape(x.shape[:2] + (-1,)).any(axis=2)
+            ret[start:start+x.shape[0]] = np.where(nonzero.any(axis=1), x.shape[1] - np.argmax(nonzero[:, ::-1], axis=1), 0)
+        return ret
+
     def random(self, random):
         self.random = random
         return self
 
+    def _setrng(self, rng):
+        self.rng = rng
+        self.feeds = tuple([feed.withrng(rng) if isinstance(feed, DynamicDataFeed) else feed for feed in self.feeds])
+
     # batching
     def reset(self):
         if self.random is not False:
-            np.random.shuffle(self.iteridxs)
+            self.rng.shuffle(self.iteridxs)
+        if self._bucketfeeds is not None and self.batsize is not None:
+            self._bucket()
         self.offset = 0
 
+    def _bucket(self):      # rearranges iteridxs into batches of examples of similar length
+        sortedidxs = self.iteridxs[np.argsort(self._seqlens[self.iteridxs], kind="mergesort")]
+        numfull = self.size // self.batsize
+        # the smaller batch (fed last) is a slice at a random batch boundary of the sorted examples, not always the longest
+        start = self.rng.randint(0, numfull + 1) * self.batsize if self.random is not False else numfull * self.batsize
+        end = start + self.size - numfull * self.batsize
+        batches = np.concatenate([sortedidxs[:start], sortedidxs[end:]]).reshape((numfull, self.batsize))
+        if self.random is not False:
+            batches = batches[self.rng.permutation(numfull)]
+        self.iteridxs = np.concatenate([batches.flatten(), sortedidxs[start:end]])
+
     def hasnextbatch(self):
         ret = self.offset <= self.size-2
         if not ret and self.autoreset:
@@ -42,12 +90,28 @@ class DataFeeder(object): # contains data feeds
     def nextbatch(self):
         if self.batsize is None:
             self.offset = self.size # ensure stop
-            return [x[:] for x in self.feeds]
+            return self._trim([x[:] for x in self.feeds], self._seqlens)
+        sampleidxs = self.nextbatchidxs()
+        return self._trim([x[sampleidxs] for x in self.feeds],
+                          self._seqlens[sampleidxs] if self._seqlens is not None else None)
+
+    def _trim(self, batch, seqlens):
+        if self._bucketfeeds is None:
+            return batch
+        maxlen = max(np.max(seqlens), 1)
+        for i in self._bucketfeeds:
+            batch[i] = batch[i][:, :maxlen]
+        return batch
+
+    def nextbatchidxs(self):    # advances like nextbatch() but returns the indexes of the examples in the batch
+        if self.batsize is None:
+            self.offset = self.size
+            return np.arange(self.size)
         start = self.offset
         end = min(self.offset+self.batsize, self.size)
-        sampleidxs = self.iteridxs[start:end]
+        sampleidxs = self.iteridxs[start:end].copy()    # iteridxs is reshuffled in place by reset()
         self.offset = end
-        return [x[sampleidxs] for x in self.feeds]
+        return sampleidxs
 
     def split(self, split=2, random=False): # creates two new datafeeders with disjoint splits
         splitidxs = np.arange(0, self.size)
@@ -75,11 +139,128 @@ class DataFeeder(object): # contains data feeds
         dftrain = DataFeeder(*[self.splitfeed(feed, nsplitidxs) for feed in self.feeds])
         return dftrain, dfvalid
 
-    def splitfeed(self, feed, idxs):
+    def splitfeed(self, feed, idxs):    # splits are index views on the feeds, no data is copied
         if isinstance(feed, DataFeed):
             return feed.get(idxs)
         else:
-            return feed[idxs]
+            return IdxViewFeed(feed, idxs=np.asarray(idxs))
+
+
+class BatchIdxFeeder(object):
+    '''
+    Feeds the example indexes of the batches of a DataFeeder instead of the data, batchespercall batches at a time
+    (concatenated, the last batch of an epoch may be smaller).
+    '''
+    def __init__(self, datafeeder, batchespercall=1):
+        self.datafeeder = datafeeder
+        self.batchespercall = batchespercall
+        self._numbats = int(ceil(datafeeder._numbats * 1. / batchespercall))
+        self._exhausted = False
+
+    def hasnextbatch(self):
+        if self._exhausted:     # already found out while gathering the previous batches
+            self._exhausted = False
+            return False
+        return self.datafeeder.hasnextbatch()
+
+    def nextbatch(self):
+        idxs = [self.datafeeder.nextbatchidxs()]
+        while len(idxs) < self.batchespercall:
+            if not self.datafeeder.hasnextbatch():
+                self._exhausted = True
+                break
+            idxs.append(self.datafeeder.nextbatchidxs())
+        return [np.concatenate(idxs).astype("int32")]
+
+
+class PrefetchDataFeeder(object):
+    '''
+    Wraps a DataFeeder and builds its next batches in a background thread, at most prefetch batches ahead.
+    Batches come in the same order and hasnextbatch()/reset() behave as for the wrapped DataFeeder
+    (which shuffles and samples with its own random stream, not np.random).
+    The thread also prefetches the start of the next epoch (if the DataFeeder autoresets), close() stops it.
+    '''
+    _BATCH, _EPOCHEND, _ERROR = range(3)
+
+    def __init__(self, datafeeder, prefetch=2):
+        self.datafeeder = datafeeder
+        self.prefetch = prefetch
+        self._queue = None
+        self._stop = None
+        self._thread = None
+        self._next = None
+
+    def __getattr__(self, item):    # size, batsize, _numbats, feeds, ... of the wrapped DataFeeder
+        if item == "datafeeder":
+            raise AttributeError()
+        return getattr(self.datafeeder, item)
+
+    # fluent settings
+    def numbats(self, numbats):
+        self.close()
+        self.datafeeder.numbats(numbats)
+        if self.datafeeder.offset > 0:      # restart the epoch the thread has advanced into
+            self.datafeeder.reset()
+        return self
+
+    # batching
+    def reset(self):
+        self.close()
+        self.datafeeder.reset()
+
+    def hasnextbatch(self):
+        if self._next is None:
+            if self._thread is None:
+                self._start()
+            self._next = self._queue.get()
+        kind, content = self._next
+        if kind == self._ERROR:
+            self._next = None
+            self.close()
+            raise content[0], content[1], content[2]
+        elif kind == self._EPOCHEND:
+            self._next = None
+            if not self.datafeeder.autoreset:
+                self.close()
+            return False
+        return True
+
+    def nextbatch(self):
+        if self._next is None:
+            self.hasnextbatch()
+        ret = self._next[1]
+        self._next = None
+        return ret
+
+    def close(self):    # stops the prefetching thread, dropping prefetched batches
+        if self._thread is not None:
+            self._stop.set()
+            while self._thread.is_alive():     # unblock the producer
+                try:
+                    self._queue.get(timeout=0.01)
+                except Empty:
+                    pass
+            self._thread = None
+            self._next = None
+
+    def _start(self):
+        self._queue = Queue(maxsize=self.prefetch)
+        self._stop = Event()
+        self._thread = Thread(target=self._produce, args=(self._queue, self._stop))
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _produce(self, queue, stop):
+        try:
+            while not stop.is_set():
+                if self.datafeeder.hasnextbatch():      # resets the wrapped DataFeeder at the end of an epoch
+                    queue.put((self._BATCH, self.datafeeder.nextbatch()))
+                else:
+                    queue.put((self._EPOCHEND, None))
+                    if not self.datafeeder.autoreset:
+                        break
+        except Exception:
+            queue.put((self._ERROR, sys.exc_info()))
 
 
 class DataFeed(object):
@@ -106,15 +287,193 @@ class DataFeed(object):
         return self.data.__getitem__(item)
 
     def get(self, idxs):    # should return DataFeed of the same type
-        pass
+        return IdxViewFeed(self.data, idxs=np.asarray(idxs))
+
+
+class IdxViewFeed(DataFeed):
+    '''
+    View on the examples idxs (None: all) of a feed (numpy array or DataFeed), gathered from the underlying feed at batch time.
+    get() composes the indexes, the underlying data is never copied.
+    '''
+    def __init__(self, data, idxs=None, **kw):
+        super(IdxViewFeed, self).__init__(data, **kw)
+        self.idxs = idxs
+
+    @property
+    def shape(self):
+        if self.idxs is None:
+            return self.data.shape
+        return (self.idxs.shape[0],) + tuple(self.data.shape[1:])
 
+    @property
+    def ndim(self):
+        return len(self.shape)
 
-class DynamicDataFeed(DataFeed): # a dynamic data generator (e.g. for random negative sampling)
     def __getitem__(self, item):
-        pass # TODO
+        if self.idxs is None:
+            return self._gather(item)
+        return self._gather(self.idxs[item])
+
+    def _gather(self, item):     # item: int, slice or index array into data
+        return self.data[item]
+
+    def get(self, idxs):
+        return self.__class__(self.data, idxs=self._subidxs(idxs))
+
+    def _subidxs(self, idxs):
+        idxs = np.asarray(idxs)
+        return self.idxs[idxs] if self.idxs is not None else idxs
+
+
+class MemmapDataFeed(IdxViewFeed):
+    '''
+    Wraps a memory-mapped array (np.memmap or path of a .npy file), for data that does not fit in memory.
+    Batches are read in sorted index order.
+    '''
+    def __init__(self, data, idxs=None, **kw):     # data: np.memmap or path
+        if isinstance(data, basestring):
+            data = np.load(data, mmap_mode="r")
+        super(MemmapDataFeed, self).__init__(data, idxs=idxs, **kw)
+
+    def _gather(self, item):
+        if not isinstance(item, (np.ndarray, list)) or np.ndim(item) == 0:     # int or slice: contiguous read
+            return np.array(self.data[item])
+        item = np.asarray(item)
+        order = np.argsort(item, kind="mergesort")
+        ret = np.empty((item.shape[0],) + self.data.shape[1:], dtype=self.data.dtype)
+        ret[order] = self.data[item[order]]     # read in file order
+        return ret
+
+
+class RaggedFeed(IdxViewFeed):
+    '''
+    Nested integer sequences (e.g. words of chars) stored CSR style: the non-padding values and, per nesting level,
+    offsets into the next level (level 0: examples, the last level: into values).
+    Batches are padded with zeros to shape (default: longest sequence of every level), longer sequences are truncated.
+    '''
+    def __init__(self, values, offsets, shape=None, idxs=None, **kw):
+        super(RaggedFeed, self).__init__(values, idxs=idxs, **kw)
+        self.offsets = offsets
+        if shape is None:
+            shape = (offsets[0].shape[0] - 1,) + tuple([int(np.max(np.diff(off), initial=0)) for off in offsets])
+        self.padshape = tuple(shape)
+
+    @property
+    def shape(self):
+        if self.idxs is None:
+            return self.padshape
+        return (self.idxs.shape[0],) + self.padshape[1:]
+
+    def _gather(self, item):
+        rows = item
+        if isinstance(item, slice):
+            rows = np.arange(*item.indices(self.padshape[0]))
+        rows = np.asarray(rows)
+        ret = np.zeros((rows.size,) + self.padshape[1:], dtype=self.data.dtype)
+        pos = (np.arange(rows.size),)     # positions in ret of the items of the current level
+        src = rows.flatten()              # their indexes in the current level
+        for level, off in enumerate(self.offsets):
+            starts = off[src]
+            lens = off[src + 1] - starts
+            within = np.arange(np.sum(lens)) - np.repeat(np.cumsum(lens) - lens, lens)
+            keep = within < self.padshape[level + 1]
+            pos = tuple([np.repeat(p, lens)[keep] for p in pos]) + (within[keep],)
+            src = (np.repeat(starts, lens) + within)[keep]
+        ret[pos] = self.data[src]
+        return ret[0] if rows.ndim == 0 else ret
+
+    def get(self, idxs):
+        return RaggedFeed(self.data, self.offsets, shape=self.padshape, idxs=self._subidxs(idxs))
+
+    @classmethod
+    def fromdense(cls, feed, chunksize=10000):  # feed: zero-padded array or feed, trailing zeros of every level are padding
+        lens, values = None, []     # lengths per level and values, per chunk
+        for start in range(0, feed.shape[0], chunksize):
+            x = np.asarray(feed[start:start + chunksize])
+            chunklens, mask = cls._ragged(x)
+            lens = [[] for l in chunklens] if lens is None else lens
+            for levellens, l in zip(lens, chunklens):
+                levellens.append(l)
+            values.append(x[mask])
+        offsets = [np.concatenate([[0], np.cumsum(np.concatenate(l))]).astype("int64") for l in lens]
+        return cls(np.concatenate(values).astype(feed.dtype), offsets, shape=feed.shape)
+
+    @staticmethod
+    def _ragged(x):     # flat lengths of the non-padding items of every level (outermost first), mask of the values
+        nonzero, lens = x != 0, []
+        for _ in range(x.ndim - 1):
+            lens.insert(0, np.where(nonzero.any(axis=-1), nonzero.shape[-1] - np.argmax(nonzero[..., ::-1], axis=-1), 0))
+            nonzero = lens[0] > 0
+        mask = np.ones((x.shape[0],), dtype="bool")
+        for level in range(len(lens)):     # keep only the lengths of non-padding items
+            levellens = lens[level][mask]
+            mask = mask[..., None] & (np.arange(x.shape[level + 1]) < lens[level][..., None])
+            lens[level] = levellens
+        return lens, mask
+
+
+class DynamicDataFeed(IdxViewFeed): # a dynamic data generator (e.g. for random negative sampling)
+    '''
+    Generates new data from the examples of data every time a batch is gathered, get() returns a view.
+    Random generators draw from rng, a DataFeeder uses copies on its own random stream (see withrng()).
+    '''
+    rng = np.random
+
+    def _gather(self, item):
+        return self.generate(np.asarray(self.data[item]))
+
+    def generate(self, x):  # x: batch of examples of data ==> batch of generated data
+        raise NotImplementedError("use subclass")
 
     def get(self, idxs): # create a new Dynamic Data Feed
-        pass # TODO
+        ret = copy(self)
+        ret.idxs = self._subidxs(idxs)
+        return ret
+
+    def withrng(self, rng):     # view that generates with rng
+        ret = copy(self)
+        ret.rng = rng
+        return ret
+
+
+class CorruptedFeed(DynamicDataFeed):
+    '''
+    Corrupted copies of examples (triples or paths of ids, or single ids) for margin-based training:
+    negrate copies (axis 1) per example, in every copy one of the positions corrupt is replaced by an id from [0, numids),
+    drawn uniformly or in proportion to freqs (then numids = len(freqs)).
+    '''
+    def __init__(self, data, numids=None, negrate=1, corrupt=(-1,), freqs=None, idxs=None, **kw):
+        super(CorruptedFeed, self).__init__(data, idxs=idxs, **kw)
+        self.negrate = negrate
+        self.corrupt = np.asarray(corrupt)
+        self.cdf = None
+        if freqs is not None:
+            self.cdf = np.cumsum(freqs, dtype="float64")
+            self.cdf /= self.cdf[-1]
+            numids = len(freqs)
+        self.numids = numids
+
+    @property
+    def shape(self):
+        shape = super(CorruptedFeed, self).shape
+        return (shape[0], self.negrate) + tuple(shape[1:])
+
+    def generate(self, x):
+        ret = np.repeat(x[:, None], self.negrate, axis=1)   # (batsize, negrate, ...)
+        ids = self.sample(ret.shape[:2]).astype(ret.dtype)
+        if x.ndim == 1:
+            return ids
+        if len(self.corrupt) == 1:
+            ret[:, :, self.corrupt[0]] = ids
+        else:
+            positions = self.corrupt[self.rng.randint(0, len(self.corrupt), ret.shape[:2])]
+            ret[np.arange(ret.shape[0])[:, None], np.arange(ret.shape[1])[None, :], positions] = ids
+        return ret
+
+    def sample(self, shape):
+        if self.cdf is None:
+            return self.rng.randint(0, self.numids, shape)
+        return np.minimum(np.searchsorted(self.cdf, self.rng.random_sample(shape), side="right"), self.numids - 1)
 
 if __name__ == "__main__":
     x = np.random.random((10, 10))
@@ -0,0 +1,243 @@
+import cPickle as pickle
+import hashlib, os, shutil, sys, tempfile, warnings
+from contextlib import contextmanager
+from multiprocessing import Process
+
+import numpy as np
+import theano
+from theano.compile.sharedvalue import SharedVariable
+from theano.gof.graph import Constant, inputs as graphinputs, io_toposort
+
+
+@contextmanager
+def deeprecursion(limit=50000):     # (un)pickling graphs recurses along their depth
+    old = sys.getrecursionlimit()
+    sys.setrecursionlimit(max(old, limit))
+    try:
+        yield
+    finally:
+        sys.setrecursionlimit(old)
+
+
+class FunctionCache(object):
+    '''
+    Disk cache of compiled theano functions, reused across processes.
+    Keyed on a structural hash of the graph (outputs and updates, so the objective and optimizer are included),
+    the input types and the theano version and config, variable names are ignored.
+    Functions are stored without the values of their shared variables,
+    a cached function is rewired to the shared variables of the graph it is loaded for.
+    Disabled by default, enable() it or set TEAFACTO_FNCACHE=1.
+    '''
+    def __init__(self, path=None, enabled=False):
+        self.path = path if path is not None else os.path.join(theano.config.compiledir, "teafacto_fncache")
+        self.enabled = enabled
+        self.hits = 0
+        self.misses = 0
+        self.savefailures = 0
+
+    def enable(self, path=None):
+        if path is not None:
+            self.path = path
+        self.enabled = True
+        return self
+
+    def disable(self):
+        self.enabled = False
+        return self
+
+    @property
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "savefailures": self.savefailures,
+                "entries": len(os.listdir(self.path)) if os.path.isdir(self.path) else 0}
+
+    def purge(self):
+        if os.path.exists(self.path):
+            shutil.rmtree(self.path)
+        self.hits = 0
+        self.misses = 0
+        self.savefailures = 0
+
+    def function(self, inputs, outputs, updates=None, **kw):    # drop-in for theano.function
+        updates = list(updates.items() if isinstance(updates, dict) else updates) if updates is not None else []
+        if not self.enabled or "givens" in kw:
+            return theano.function(inputs=inputs, outputs=outputs, updates=updates, **kw)
+        key, shareds = self.graphkey(inputs, outputs, updates, **kw)
+        entrypath = os.path.join(self.path, key + ".pkl")
+        if os.path.exists(entrypath):
+            try:
+                ret = self._load(entrypath, shareds)
+                self.hits += 1
+                return ret
+            except Exception:   # corrupted or stale entry: compile again
+                pass
+        self.misses += 1
+        ret = theano.function(inputs=inputs, outputs=outputs, updates=updates, **kw)
+        try:
+            self._save(entrypath, ret, shareds)
+        except Exception as e:   # e.g. ops that can not be pickled, such functions are just not cached
+            self.savefailures += 1
+            warnings.warn("compiled function not cached: %s: %s" % (e.__class__.__name__, e))
+        return ret
+
+    def _save(self, entrypath, f, shareds):
+        fshareds = [i.variable for i in f.maker.inputs if i.implicit]
+        positions = [[j for j, shared in enumerate(shareds) if shared is fshared][0] for fshared in fshareds]
+        containers = [c for i, c in zip(f.maker.inputs, f.input_storage) if i.implicit]
+        values = [c.storage[0] for c in containers]
+        if not os.path.exists(self.path):
+            os.makedirs(self.path)
+        tmppath = "%s.%d.tmp" % (entrypath, os.getpid())
+        try:    # store the function without the values of its shared variables
+            for c, value in zip(containers, values):
+                if isinstance(value, np.ndarray):
+                    c.storage[0] = np.zeros([1 if b else 0 for b in c.type.broadcastable], dtype=value.dtype)
+            with open(tmppath, "wb") as fl, deeprecursion():
+                pickle.dump((positions, f), fl, -1)
+        finally:
+            for c, value in zip(containers, values):
+                c.storage[0] = value
+        os.rename(tmppath, entrypath)
+
+    def _load(self, entrypath, shareds):
+        with open(entrypath, "rb") as fl, deeprecursion():
+            positions, stored = pickle.load(fl)
+        # build a new function from the optimized graph of the stored one, on the storage of the given shared variables
+        # (Function.copy(swap=...) loses the inplace bookkeeping of the graph, which breaks scans)
+        maker = stored.maker
+        positions = iter(positions)
+        for inp in maker.inputs:
+            if inp.implicit:
+                shared = shareds[next(positions)]
+                inp.variable, inp.value = shared, shared.container
+        return maker.__class__(inputs=maker.inputs, outputs=maker.orig_outputs, fgraph=maker.fgraph, mode=maker.mode,
+                               on_unused_input="ignore", function_builder=maker.function_builder,
+                               accept_inplace=True).create([inp.value for inp in maker.inputs])
+
+    @classmethod
+    def graphkey(cls, inputs, outputs, updates, **kw):
+        '''
+        Structural hash of the function and the shared variables of the graph in order of appearance.
+        '''
+        outputlist = list(outputs) if isinstance(outputs, (list, tuple)) else [outputs]
+        updatelist = list(updates)
+        roots = list(inputs) + [shared for shared, _ in updatelist]
+        desc, shareds = cls.graphstr(list(inputs), outputlist + [upd for _, upd in updatelist], extraroots=roots)
+        desc += "\nupdates: %s" % [[i for i, s in enumerate(shareds) if s is shared] for shared, _ in updatelist]
+        desc += "\nsingle output: %s\nsettings: %s" % (not isinstance(outputs, (list, tuple)), sorted(kw.items()))
+        desc += "\ntheano: %s %s %s %s" % (theano.__version__, theano.config.floatX, theano.config.device,
+                                            theano.config.mode)
+        return hashlib.md5(desc).hexdigest(), shareds
+
+    @classmethod
+    def graphstr(cls, inputs, outputs, extraroots=()):
+        varids = {}
+        shareds = []
+        lines = []
+
+        def varstr(var):
+            if var not in varids:
+                if var.owner is not None:
+                    raise Exception("output of unknown node")
+                if any([var is inp for inp in inputs]):
+                    varids[var] = "I%d" % [i for i, inp in enumerate(inputs) if inp is var][0]
+                elif isinstance(var, SharedVariable):
+                    varids[var] = "S%d" % len(shareds)
+                    shareds.append(var)
+                elif isinstance(var, Constant):
+                    data = np.asarray(var.data)
+                    varids[var] = "C(%s)" % (repr(var.data) if data.size < 20 else hashlib.md5(data.tostring()).hexdigest())
+                else:
+                    varids[var] = "R%d" % len(varids)
+            return "%s:%s" % (varids[var], var.type)
+
+        for node in io_toposort(graphinputs(outputs), outputs):
+            line = "%s(%s)" % (cls.opstr(node.op), ", ".join([varstr(inp) for inp in node.inputs]))
+            for out in node.outputs:
+                varids[out] = "V%d" % len(varids)
+            lines.append("%s -> %s" % (line, ", ".join([varstr(out) for out in node.outputs])))
+        lines.append("outputs: %s" % ", ".join([varstr(out) for out in outputs]))
+        for root in extraroots:     # e.g. update targets that are not used in the graph
+            varstr(root)
+        return "\n".join(lines), shareds
+
+    @classmethod
+    def opstr(cls, op):
+        ret = "%s.%s{%s}" % (op.__class__.__module__, op.__class__.__name__, op)
+        if hasattr(op, "__props__"):
+            ret += repr([(prop, str(getattr(op, prop))) for prop in op.__props__])
+        if isinstance(op, theano.scan_module.scan_op.Scan):     # inner graph
+            inner, _ = cls.graphstr(op.inputs, op.outputs)
+            ret += "[%s | %s]" % (sorted([(k, str(v)) for k, v in op.info.items()]), inner)
+        return ret
+
+
+class TieredFunction(object):
+    '''
+    Function that is usable right away: compiled with a cheap mode (fastmode) first,
+    while a forked process compiles it with the default mode into a function cache (a temporary one if cache is not enabled).
+    Switches to the optimized function at the first call after it is ready, the shared variables are the same.
+    onswap() is called after switching.
+    '''
+    def __init__(self, inputs, outputs, updates=None, fastmode="FAST_COMPILE", cache=None, onswap=None):
+        updates = list(updates.items() if isinstance(updates, dict) else updates) if updates is not None else []
+        self._tmpdir = None
+        if cache is None or not cache.enabled:
+            self._tmpdir = tempfile.mkdtemp()
+            cache = FunctionCache(path=self._tmpdir, enabled=True)
+        self.cache = cache
+        self.onswap = onswap
+        self._proc = None
+        key, self._shareds = cache.graphkey(inputs, outputs, updates)
+        self._entrypath = os.path.join(cache.path, key + ".pkl")
+        self.optimized = False
+        if os.path.exists(self._entrypath) and self._swap():
+            return
+        self._graph = (inputs, outputs, updates)
+        self.f = theano.function(inputs=inputs, outputs=outputs, updates=updates, mode=fastmode)
+        self._proc = Process(target=cache.function, args=(inputs, outputs, updates))
+        self._proc.daemon = True
+        self._proc.start()
+
+    def __call__(self, *args):
+        if self._proc is not None and not self._proc.is_alive():
+            self._finish()
+        return self.f(*args)
+
+    def wait(self):     # blocks until the optimized function is used (or its compilation failed)
+        if self._proc is not None:
+            self._proc.join()
+            self._finish()
+        return self
+
+    def close(self):
+        if self._proc is not None:
+            self._proc.terminate()
+            self._proc.join()
+            self._proc = None
+        if self._tmpdir is not None:
+            shutil.rmtree(self._tmpdir, ignore_errors=True)
+            self._tmpdir = None
+
+    def _finish(self):
+        self._proc.join()
+        exitcode, self._proc = self._proc.exitcode, None
+        if not (os.path.exists(self._entrypath) and self._swap()):
+            # e.g. an exception in the child, a function that could not be stored or a device that does not survive fork
+            warnings.warn("optimized function was not compiled in the background (exit code %s), compiling it now" % exitcode)
+            inputs, outputs, updates = self._graph
+            self.f = theano.function(inputs=inputs, outputs=outputs, updates=updates)
+            self.optimized = True
+        if self.onswap is not None:
+            self.onswap()
+        self.close()
+
+    def _swap(self):
+        try:
+            self.f = self.cache._load(self._entrypath, self._shareds)
+        except Exception:   # keep the cheap function
+            return False
+        self.optimized = True
+        return True
+
+
+fncache = FunctionCache(enabled=os.environ.get("TEAFACTO_FNCACHE", "0") == "1")
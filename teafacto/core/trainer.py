@@ -5,13 +5,19 @@ from IPython import embed
 
 import numpy as np
 import theano
+from collections import OrderedDict
 from lasagne.objectives import *
 from lasagne.regularization import l1, l2
 from lasagne.updates import *
 from theano import tensor as tensor
+from theano.tensor.subtensor import AdvancedSubtensor1
+from theano.tensor.extra_ops import Unique
+from theano.scan_module.scan_op import Scan
 
 #from core import Input
-from teafacto.core.datafeed import DataFeeder, SplitIdxIterator
+from teafacto.core.datafeed import DataFeeder, SplitIdxIterator, BatchIdxFeeder, PrefetchDataFeeder, DynamicDataFeed
+from teafacto.core.checkpoint import CheckpointWriter, loadcheckpoint
+from teafacto.core.fncache import fncache, TieredFunction
 from teafacto.util import ticktock as TT
 
 
@@ -32,6 +38,57 @@ class thresh_lr(DynamicLearningParam):
         return lr if epoch < self.thresh else 0.
 
 
+######################## ROW-SPARSE OPTIMIZERS ########################
+# Update only the given (unique) rows of a parameter, given the gradient for those rows.
+# Return the new values of the rows and the updates of the optimizer state.
+# Optimizer state is only updated for the given rows (lazy).
+
+def sparse_sgd(param, idxs, grad, learning_rate):
+    return param[idxs] - learning_rate * grad, OrderedDict()
+
+
+def sparse_adagrad(param, idxs, grad, learning_rate, epsilon=1e-6):
+    value = param.get_value(borrow=True)
+    accu = theano.shared(np.zeros(value.shape, dtype=value.dtype), broadcastable=param.broadcastable)
+    accurows = accu[idxs] + grad ** 2
+    updates = OrderedDict([(accu, tensor.set_subtensor(accu[idxs], accurows))])
+    return param[idxs] - learning_rate * grad / tensor.sqrt(accurows + epsilon), updates
+
+
+def sparse_adam(param, idxs, grad, learning_rate, beta1=0.9, beta2=0.999, epsilon=1e-8):
+    t_prev = theano.shared(np.cast[theano.config.floatX](0.))
+    t = t_prev + 1
+    a_t = learning_rate * tensor.sqrt(1 - beta2 ** t) / (1 - beta1 ** t)
+    value = param.get_value(borrow=True)
+    m_prev = theano.shared(np.zeros(value.shape, dtype=value.dtype), broadcastable=param.broadcastable)
+    v_prev = theano.shared(np.zeros(value.shape, dtype=value.dtype), broadcastable=param.broadcastable)
+    m_t = beta1 * m_prev[idxs] + (1 - beta1) * grad
+    v_t = beta2 * v_prev[idxs] + (1 - beta2) * grad ** 2
+    updates = OrderedDict([(m_prev, tensor.set_subtensor(m_prev[idxs], m_t)),
+                           (v_prev, tensor.set_subtensor(v_prev[idxs], v_t)),
+                           (t_prev, t)])
+    return param[idxs] - a_t * m_t / (tensor.sqrt(v_t) + epsilon), updates
+
+
+class ParamSnapshot(object):
+    '''
+    Copies of the values of parameters in numpy buffers, which are allocated once and reused by every take().
+    restore() sets the values back on the same parameters, so compiled functions stay valid.
+    '''
+    def __init__(self, params):
+        self.params = list(params)
+        self.values = [np.empty_like(param.d.get_value(borrow=True)) for param in self.params]
+
+    def take(self):
+        for param, value in zip(self.params, self.values):
+            value[...] = param.d.get_value(borrow=True)
+        return self
+
+    def restore(self):
+        for param, value in zip(self.params, self.values):
+            param.d.set_value(value)        # copied, the buffer stays ours
+
+
 class ModelTrainer(object):
     def __init__(self, model, gold):
         self.model = model
@@ -39,15 +96,32 @@ class ModelTrainer(object):
         self.validsetmode= False
         self.average_err = True # TODO: do we still need this?
         self._autosave = False
+        self._savepath = None
+        self._resumepath = None
+        self._startiter = 1     # first epoch of the next trainloop, after the last one of a resumed checkpoint
+        self._checkpointwriter = None
+        self._optimstate = OrderedDict()    # param ==> shared vars of its optimizer state
+        self._ingraph = False
+        self._batchespercall = 1
+        self._prefetch = 0
+        self._prefetchers = []
+        self._bucketfeeds = None
+        self._tiered = None
+        self._tieredfuns = []
+        self._sampler = None
         # training settings
         self.learning_rate = None
         self.dynamic_lr = None
         self.objective = None
         self.regularizer = None
         self.optimizer = None
+        self.sparseoptimizer = None
         self.traindata = None
         self.traingold = None
         self.gradconstraints = []
+        self.batchhooks = []
+        self.feedhooks = []
+        self._batchcount = 0
         # validation settings
         self._validinter = 1
         self.trainstrategy = self._train_full
@@ -216,36 +290,135 @@ class ModelTrainer(object):
     def sgd(self, lr):
         self._setlr(lr)
         self.optimizer = lambda x, y, l: sgd(x, y, learning_rate=l)
+        self.sparseoptimizer = lambda p, i, g, l: sparse_sgd(p, i, g, learning_rate=l)
         return self
 
     def momentum(self, lr, mome=0.9):
         self._setlr(lr)
         self.optimizer = lambda x, y, l: momentum(x, y, learning_rate=l, momentum=mome)
+        self.sparseoptimizer = None
         return self
 
     def nesterov_momentum(self, lr, momentum=0.9):
         self._setlr(lr)
         self.optimizer = lambda x, y, l: nesterov_momentum(x, y, learning_rate=l, momentum=momentum)
+        self.sparseoptimizer = None
         return self
 
     def adagrad(self, lr=1.0, epsilon=1e-6):
         self._setlr(lr)
         self.optimizer = lambda x, y, l: adagrad(x, y, learning_rate=l, epsilon=epsilon)
+        self.sparseoptimizer = lambda p, i, g, l: sparse_adagrad(p, i, g, learning_rate=l, epsilon=epsilon)
         return self
 
     def rmsprop(self, lr=1., rho=0.9, epsilon=1e-6):
         self._setlr(lr)
         self.optimizer = lambda x, y, l: rmsprop(x, y, learning_rate=l, rho=rho, epsilon=epsilon)
+        self.sparseoptimizer = None
         return self
 
     def adadelta(self, lr=1., rho=0.95, epsilon=1e-6):
         self._setlr(lr)
         self.optimizer = lambda x, y, l: adadelta(x, y, learning_rate=l, rho=rho, epsilon=epsilon)
+        self.sparseoptimizer = None
         return self
 
     def adam(self, lr=0.001, b1=0.9, b2=0.999, epsilon=1e-8):
         self._setlr(lr)
         self.optimizer = lambda x, y, l: adam(x, y, learning_rate=l, beta1=b1, beta2=b2, epsilon=epsilon)
+        self.sparseoptimizer = lambda p, i, g, l: sparse_adam(p, i, g, learning_rate=l, beta1=b1, beta2=b2, epsilon=epsilon)
+        return self
+
+    ################### BATCH HOOKS ######################
+    def batchhook(self, f, inter=1):    # calls f() after every inter training batches (counted over epochs)
+        self.batchhooks.append((f, inter))
+        return self
+
+    def feedhook(self, f):      # calls f(*batch) with the data of every batch, before it is fed (training and validation)
+        self.feedhooks.append(f)
+        return self
+
+    def _run_batchhooks(self):
+        self._batchcount += 1
+        for f, inter in self.batchhooks:
+            if self._batchcount % inter == 0:
+                f()
+
+    ################### SAMPLED OUTPUTS ##################
+    def sampled(self, sampler):
+        """
+        Trains against candidates sampled for every training batch, e.g. by a sampled() MemoryAddress:
+        sampler.sample(gold) is called before every training batch and the training objective gets the positions of
+        the gold in the candidates (sampler.goldpos(gold)) as gold. Validation uses a graph built with the full output.
+        """
+        self._sampler = sampler
+        return self
+
+    def _rebuild(self, model, sampled):     # rebuilds the graph of model with sampled or full outputs
+        if sampled:
+            self._sampler.sampled()
+        else:
+            self._sampler.full
+        model.autobuild(*self.traindata)
+
+    ################### IN-GRAPH BATCHES #################
+    def ingraph(self, batchespercall=1):
+        """
+        Loads the training data into shared variables once, the training function then only takes the indexes
+        of the examples in a batch and gathers the batch in-graph.
+        With batchespercall > 1, one call trains on that many consecutive batches (in a scan),
+        the training error, progress and batch hooks then count calls instead of batches.
+        Feed hooks, bucketing and dynamic data feeds are not supported, the data of a batch is never on the host.
+        """
+        self._ingraph = True
+        self._batchespercall = batchespercall
+        return self
+
+    def _ingraphtrainfun(self, inputs, cost, updates):     # returns a function that compiles the training function for a DataFeeder
+        def build(datafeeder):
+            assert(not any([isinstance(feed, DynamicDataFeed) for feed in datafeeder.feeds]))  # would be generated once
+            data = [theano.shared(np.asarray(feed[:]), name="ingraph_data") for feed in datafeeder.feeds]
+            idxs = tensor.ivector("batchidxs")
+            if self._batchespercall == 1:
+                return theano.function(inputs=[idxs], outputs=[cost], updates=updates,
+                                       givens=[(inp, feed[idxs]) for inp, feed in zip(inputs, data)])
+            batsize = datafeeder.batsize if datafeeder.batsize is not None else datafeeder.size
+
+            def step(start, idxs):
+                batchidxs = idxs[start:start+batsize]
+                outs = theano.clone([cost] + [upd for _, upd in updates],
+                                    replace=[(inp, feed[batchidxs]) for inp, feed in zip(inputs, data)])
+                return outs[0], OrderedDict(zip([var for var, _ in updates], outs[1:]))
+            costs, scanupdates = theano.scan(fn=step, sequences=tensor.arange(0, idxs.shape[0], batsize),
+                                              non_sequences=idxs)
+            return theano.function(inputs=[idxs], outputs=[tensor.mean(costs)], updates=scanupdates)
+        return build
+
+    ################### PREFETCHING ######################
+    def prefetch(self, numbatches=2):    # builds up to numbatches next batches in a background thread
+        self._prefetch = numbatches
+        return self
+
+    def _closeprefetchers(self):
+        for prefetcher in self._prefetchers:
+            prefetcher.close()
+        self._prefetchers = []
+
+    ################### TIERED COMPILATION ###############
+    def tiered(self, fastmode="FAST_COMPILE"):  # starts training with a function compiled in fastmode,
+                                                # switches to the optimized one when a background process has compiled it
+                                                # (not with ingraph())
+        self._tiered = fastmode
+        return self
+
+    def _closetieredfuns(self):
+        for tieredfun in self._tieredfuns:
+            tieredfun.close()
+        self._tieredfuns = []
+
+    ################### BUCKETING ########################
+    def bucketed(self, *feedidxs):     # batches examples of similar length, trims the sequence feeds feedidxs per batch
+        self._bucketfeeds = feedidxs if len(feedidxs) > 0 else (0,)
         return self
 
     ################### VALIDATION ####################### --> use one of following
@@ -303,10 +476,18 @@ class ModelTrainer(object):
         self.traincheck()
         self.numbats = numbats
         self.maxiter = epochs
-        errors = self.trainstrategy()       # trains according to chosen training strategy, returns errors
-        if self.besttaker is not None:      # unfreezes best model if best choosing was chosen
-            self.model = self.model.__class__.unfreeze(self.bestmodel[0])
-            self.tt.tock("unfroze best model (%.3f) - " % self.bestmodel[1]).tick()
+        try:
+            errors = self.trainstrategy()       # trains according to chosen training strategy, returns errors
+        finally:
+            self._closeprefetchers()
+            self._closetieredfuns()
+            self._closecheckpointwriter()
+            if self._sampler is not None:   # full addressing for evaluation
+                self._rebuild(self.model, False)
+                self.model._predictf = None
+        if self.besttaker is not None and self.bestmodel[0] is not None:   # restores best parameters if best choosing was chosen
+            self.bestmodel[0].restore()
+            self.tt.tock("restored best model (%.3f) - " % self.bestmodel[1]).tick()
         ret = self.model
         if returnerrors:
             ret = (ret,) + errors
@@ -314,10 +495,14 @@ class ModelTrainer(object):
 
     def buildtrainfun(self, model):
         self.tt.tick("compiling training function")
+        if self._sampler is not None:
+            self._rebuild(model, sampled=True)
         params = model.output.allparams
         inputs = model.inputs
         loss, newinp = self.buildlosses(model, [self.objective])
         loss = loss[0]
+        if self._sampler is not None:   # objective between sampled outputs and gold positions in the sample
+            loss = theano.clone(loss, replace={self.goldvar: self._sampler.goldpos(self.goldvar)})
         if newinp is not None:
             inputs = newinp
         if self.regularizer is not None:
@@ -332,11 +517,39 @@ class ModelTrainer(object):
         #for x in params:
         #    self.tt.msg("computing gradient for %s" % str(x))
         #    grads.append(tensor.grad(cost, x.d))
-        grads = tensor.grad(cost, [x.d for x in params])  # compute gradient
+        trainparams = [x for x in params if x.lrmul != 0]   # frozen params get no gradient and no optimizer state
+        if len(trainparams) < len(params):
+            self.tt.msg("not training %d frozen params" % (len(params) - len(trainparams)))
+        sparseparams = OrderedDict()
+        if self.sparseoptimizer is not None:
+            cost = self._hoistlookups(cost, trainparams)
+            sparseparams = self._rowindexed(cost, trainparams)
+            self.tt.msg("sparse updates for: %s" % ", ".join([str(param.name) for param in sparseparams]))
+        denseparams = [x for x in trainparams if x not in sparseparams]
+        rowgrads = [r for param in sparseparams for _, r in sparseparams[param]]
+        grads = tensor.grad(cost, [x.d for x in denseparams] + rowgrads)  # compute gradient
+        grads, rowgrads = grads[:len(denseparams)], grads[len(denseparams):]
+        sparseidxs = []
+        for param in sparseparams:      # sum gradients of repeated rows
+            uses = sparseparams[param]
+            idxs = tensor.concatenate([i for i, _ in uses], axis=0)
+            grad = tensor.concatenate(rowgrads[:len(uses)], axis=0)
+            rowgrads = rowgrads[len(uses):]
+            uidxs, inv = Unique(return_inverse=True)(idxs)
+            ugrad = tensor.zeros([uidxs.shape[0]] + [grad.shape[i] for i in range(1, grad.ndim)], dtype=grad.dtype)
+            sparseidxs.append(uidxs)
+            grads.append(tensor.inc_subtensor(ugrad[inv], grad))
         self.tt.msg("computed gradients")
         grads = self._gradconstrain(grads)
-        for param, grad in zip(params, grads):
+        for param, idxs, grad in zip(sparseparams.keys(), sparseidxs, grads[len(denseparams):]):
+            newrows, upds = self.sparseoptimizer(param.d, idxs, grad, self.learning_rate*param.lrmul)
+            updates.append((param.d, tensor.set_subtensor(param.d[idxs], param.constraintf()(newrows))))
+            updates.extend(upds.items())
+            self._optimstate[param] = list(upds.keys())
+        grads = grads[:len(denseparams)]
+        for param, grad in zip(denseparams, grads):
             upds = self.optimizer([grad], [param.d], self.learning_rate*param.lrmul)
+            self._optimstate[param] = [upd for upd in upds if upd is not param.d]
             for upd in upds:
                 broken = False
                 for para in params:
@@ -348,20 +561,114 @@ class ModelTrainer(object):
                     updates.append((upd, upds[upd]))
         #print updates
         #embed()
-        trainf = theano.function(inputs=[x.d for x in inputs]+[self.goldvar], outputs=[cost], updates=updates)
+        if self._ingraph:       # compiled in getbatchloop(), when the data is known
+            trainf = self._ingraphtrainfun([x.d for x in inputs]+[self.goldvar], cost, updates)
+        elif self._tiered is not None:
+            trainf = TieredFunction(inputs=[x.d for x in inputs]+[self.goldvar], outputs=[cost], updates=updates,
+                                    fastmode=self._tiered, cache=fncache,
+                                    onswap=lambda: self.tt.msg("switched to optimized training function"))
+            self._tieredfuns.append(trainf)
+        else:
+            trainf = fncache.function(inputs=[x.d for x in inputs]+[self.goldvar], outputs=[cost], updates=updates)
         self.tt.tock("training function compiled")
+        if self._resumepath is not None:    # optimizer state only exists now
+            config = loadcheckpoint(self._resumepath, model, optimstate=self._optimstate)
+            self.learning_rate.set_value(np.cast[theano.config.floatX](config["lr"]))
+            self.tt.msg("resumed from %s (epoch %d)" % (self._resumepath, config["epoch"]))
+            self._startiter = config["epoch"] + 1
+            self._resumepath = None
         return trainf
 
+    @staticmethod
+    def _rowindexed(cost, params):
+        """
+        Finds the params that cost only uses through row lookups (e.g. embedding tables),
+        for which only the looked up rows need updates.
+        Params with constraints that do not work row by row are left out.
+        Returns an OrderedDict from param to a list of (idxs, rows) pairs, one for every lookup.
+        """
+        uses = {}
+        for node in theano.gof.graph.io_toposort(theano.gof.graph.inputs([cost]), [cost]):
+            for i, inp in enumerate(node.inputs):
+                uses.setdefault(inp, []).append((node, i))
+        ret = OrderedDict()
+        for param in params:
+            paramuses = uses.get(param.d, [])
+            if len(paramuses) > 0 and param.rowwiseconstraints and \
+                    all([isinstance(node.op, AdvancedSubtensor1) and i == 0 for node, i in paramuses]):
+                ret[param] = [(node.inputs[1], node.outputs[0]) for node, _ in paramuses]
+        return ret
+
+    @staticmethod
+    def _hoistlookups(cost, params):
+        """
+        Moves row lookups of params out of scans (e.g. embeddings in the step of an RNN encoder):
+        a param that a scan only uses as param[x_t], with x_t the step element of one of its sequences,
+        is looked up for the whole sequence before the scan and passed in as an extra sequence instead.
+        Returns the rewritten cost, in which _rowindexed() can find such params. Nested scans are not rewritten.
+        """
+        paramvars = [param.d for param in params]
+        while True:
+            for node in theano.gof.graph.io_toposort(theano.gof.graph.inputs([cost]), [cost]):
+                if isinstance(node.op, Scan):
+                    newouts = ModelTrainer._hoistscan(node, paramvars)
+                    if newouts is not None:
+                        cost = theano.clone(cost, replace=OrderedDict(zip(node.outputs, newouts)))
+                        break
+            else:
+                return cost
+
+    @staticmethod
+    def _hoistscan(node, paramvars):    # rewrites the scan of node for its first hoistable param, returns new outputs or None
+        op, info = node.op, node.op.info
+        nseqs = info["n_seqs"]
+        nonseqstart = 1 + nseqs + info["n_mit_mot"] + info["n_mit_sot"] + info["n_sit_sot"] \
+                      + info["n_shared_outs"] + info["n_nit_sot"]
+        outernonseqs = node.inputs[nonseqstart:]
+        innernonseqs = op.inputs[len(op.inputs) - len(outernonseqs):]
+        innerseqs = op.inputs[:nseqs]
+        uses = {}
+        for innernode in theano.gof.graph.io_toposort(op.inputs, op.outputs):
+            for i, inp in enumerate(innernode.inputs):
+                uses.setdefault(inp, []).append((innernode, i))
+        for j, (outer, inner) in enumerate(zip(outernonseqs, innernonseqs)):
+            paramuses = uses.get(inner, [])
+            if not any([outer is paramvar for paramvar in paramvars]) or len(paramuses) == 0 \
+                    or any([inner is out for out in op.outputs]) \
+                    or not all([isinstance(n.op, AdvancedSubtensor1) and i == 0 and n.inputs[1].ndim == 1
+                                and any([n.inputs[1] is seq for seq in innerseqs]) for n, i in paramuses]):
+                continue
+            newseqs, newinnerseqs, replace = [], [], OrderedDict()
+            for n, _ in paramuses:      # the rows of every lookup become a sequence
+                outerseq = node.inputs[1 + [k for k, seq in enumerate(innerseqs) if seq is n.inputs[1]][0]]
+                rows = outer[outerseq.flatten()]
+                rows = rows.reshape((outerseq.shape[0], outerseq.shape[1], rows.shape[1]))  # not outer.shape, a dense use
+                innerrows = n.outputs[0].type()
+                newseqs.append(tensor.patternbroadcast(rows, (False,) + innerrows.broadcastable))
+                newinnerseqs.append(innerrows)
+                replace[n.outputs[0]] = innerrows
+            newinfo = OrderedDict(info)
+            newinfo["n_seqs"] = nseqs + len(newseqs)
+            newop = Scan(innerseqs + newinnerseqs + op.inputs[nseqs:len(op.inputs) - len(outernonseqs)]
+                         + [x for x in innernonseqs if x is not inner],
+                         theano.clone(op.outputs, replace=replace), newinfo)
+            return newop.make_node(*([node.inputs[0]] + node.inputs[1:1 + nseqs] + newseqs
+                                     + node.inputs[1 + nseqs:nonseqstart]
+                                     + [x for x in outernonseqs if x is not outer])).outputs
+        return None
+
     def buildlosses(self, model, objs):
         return [aggregate(obj(model.output.d, self.goldvar), mode='mean' if self.average_err is True else 'sum') for obj in objs], None
 
     def buildvalidfun(self, model):
         self.tt.tick("compiling validation function")
+        if self._sampler is not None:
+            self._rebuild(model, sampled=False)
         metrics, newinp = self.buildlosses(model, self.validators)
         inputs = newinp if newinp is not None else model.inputs
         ret = None
         if len(metrics) > 0:
-            ret = theano.function(inputs=[x.d for x in inputs] + [self.goldvar], outputs=metrics)
+            ret = fncache.function(inputs=[x.d for x in inputs] + [self.goldvar], outputs=metrics)
         self.tt.tock("validation function compiled")
         return ret
 
@@ -369,7 +676,7 @@ class ModelTrainer(object):
     def _train_full(self): # train on all data, no validation
         trainf = self.buildtrainfun(self.model)
         err, _ = self.trainloop(
-                trainf=self.getbatchloop(trainf, DataFeeder(*(self.traindata + [self.traingold])).numbats(self.numbats)))
+                trainf=self.getbatchloop(trainf, DataFeeder(*(self.traindata + [self.traingold])).numbats(self.numbats), trainmode=True))
         return err, None, None, None
 
     def _train_validdata(self):
@@ -379,7 +686,7 @@ class ModelTrainer(object):
         vdf = DataFeeder(*(self.validdata + [self.validgold]))
         #dfvalid = df.osplit(split=self.validsplits, random=self.validrandom)
         err, verr = self.trainloop(
-                trainf=self.getbatchloop(trainf, df.numbats(self.numbats)),
+                trainf=self.getbatchloop(trainf, df.numbats(self.numbats), trainmode=True),
                 validf=self.getbatchloop(validf, vdf))
         return err, verr, None, None
 
@@ -389,7 +696,7 @@ class ModelTrainer(object):
         df = DataFeeder(*(self.traindata + [self.traingold]))
         dftrain, dfvalid = df.split(self.validsplits, self.validrandom)
         err, verr = self.trainloop(
-                trainf=self.getbatchloop(trainf, dftrain.numbats(self.numbats)),
+                trainf=self.getbatchloop(trainf, dftrain.numbats(self.numbats), trainmode=True),
                 validf=self.getbatchloop(validf, dfvalid))
         return err, verr, None, None
 
@@ -404,7 +711,7 @@ class ModelTrainer(object):
             validf = self.buildvalidfun(self.model)
             tf, vf = df.isplit(splitidxs)
             serr, sverr = self.trainloop(
-                trainf=self.getbatchloop(trainf, tf.numbats(self.numbats)),
+                trainf=self.getbatchloop(trainf, tf.numbats(self.numbats), trainmode=True),
                 validf=self.getbatchloop(validf, vf))
             err.append(serr)
             verr.append(sverr)
@@ -427,8 +734,8 @@ class ModelTrainer(object):
         self.tt.tick("training")
         err = []
         verr = []
-        stop = self.maxiter == 0
-        self.currentiter = 1
+        self.currentiter, self._startiter = self._startiter, 1
+        stop = self.maxiter == 0 or self.currentiter > self.maxiter
         evalinter = self._validinter
         evalcount = evalinter
         tt = TT("iter")
@@ -456,8 +763,11 @@ class ModelTrainer(object):
             if self.besttaker is not None:
                 modelscore = self.besttaker(([erre]+verre+[self.currentiter]))
                 if modelscore < self.bestmodel[1]:
-                    #tt.tock("freezing best with score %.3f (prev: %.3f)" % (modelscore, self.bestmodel[1]), prefix="-").tick()
-                    self.bestmodel = (self.model.freeze(), modelscore)
+                    #tt.tock("snapshotting best with score %.3f (prev: %.3f)" % (modelscore, self.bestmodel[1]), prefix="-").tick()
+                    snapshot = self.bestmodel[0]
+                    if snapshot is None:
+                        snapshot = ParamSnapshot([x for x in self.model.output.allparams if x.lrmul != 0])  # not frozen
+                    self.bestmodel = (snapshot.take(), modelscore)
             tt.tock("done", prefix="-")
             self._update_lr(self.currentiter, self.maxiter, err, verr)
             evalcount += 1
@@ -467,10 +777,21 @@ class ModelTrainer(object):
         self.tt.tock("trained").tick()
         return err, verr
 
-    def getbatchloop(self, trainf, datafeeder, verbose=True):
+    def getbatchloop(self, trainf, datafeeder, verbose=True, trainmode=False):
         '''
         returns the batch loop, loaded with the provided trainf training function and samplegen sample generator
+        batch hooks are only run in trainmode
         '''
+        if trainmode and self._ingraph:
+            assert(len(self.feedhooks) == 0 and self._sampler is None and self._bucketfeeds is None)
+            trainf = trainf(datafeeder)
+            datafeeder = BatchIdxFeeder(datafeeder, batchespercall=self._batchespercall)
+        else:
+            if self._bucketfeeds is not None:
+                datafeeder.bucketed(*self._bucketfeeds)
+            if self._prefetch > 0:
+                datafeeder = PrefetchDataFeeder(datafeeder, prefetch=self._prefetch)
+                self._prefetchers.append(datafeeder)
 
         def batchloop():
             c = 0
@@ -486,12 +807,18 @@ class ModelTrainer(object):
                     tt.live(s)
                     prevperc = perc
                 sampleinps = datafeeder.nextbatch()
+                if trainmode and self._sampler is not None:
+                    self._sampler.sample(sampleinps[-1])
+                for f in self.feedhooks:
+                    f(*sampleinps)
                 try:
                     eterr = trainf(*sampleinps)
                     if len(terr) != len(eterr) and terr.count(0.0) == len(terr):
                         terr = [0.0]*len(eterr)
                 except Exception, e:
                     raise e
+                if trainmode:
+                    self._run_batchhooks()
                 if self.average_err is True:
                     terr = [xterr*(1.0*(c)/(c+1)) + xeterr*(1.0/(c + 1)) for xterr, xeterr in zip(terr, eterr)]
                 else:
@@ -501,13 +828,36 @@ class ModelTrainer(object):
             return terr
         return batchloop
 
+    ########################## CHECKPOINTS #############
     @property
-    def autosave(self):
+    def autosave(self):     # writes a checkpoint after every epoch, in the background
         self._autosave = True
         return self
 
+    def saveto(self, path):     # checkpoint path for autosave (default: next to the default save path of the model)
+        self._savepath = path
+        return self
+
+    def resume(self, path):     # continues training from a checkpoint (parameters, optimizer state, learning rate and epoch),
+                                # train(epochs=...) then trains up to that epoch
+        self._resumepath = path
+        return self
+
     def save(self, model, filepath=None):
-        model.save(filepath=filepath)
+        if filepath is None:
+            if self._savepath is None:
+                self._savepath = model.getdefaultsavepath() + ".ckpt"
+            filepath = self._savepath
+        if self._checkpointwriter is None:
+            self._checkpointwriter = CheckpointWriter()
+        self._checkpointwriter.save(filepath, model, optimstate=self._optimstate,
+                                    config={"epoch": self.currentiter - 1,
+                                            "lr": float(self.learning_rate.get_value())})
+
+    def _closecheckpointwriter(self):     # waits until the last checkpoint is written
+        if self._checkpointwriter is not None:
+            self._checkpointwriter.close()
+            self._checkpointwriter = None
 
 '''
 class ContrastModelTrainer(ModelTrainer):
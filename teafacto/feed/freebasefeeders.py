@@ -1,25 +1,93 @@
 import numpy as np
+import os, hashlib
 from collections import OrderedDict
 
 from teafacto.feed.langfeeds import WordSeqFeed
+from teafacto.core.datafeed import MemmapDataFeed, RaggedFeed
 from teafacto.feed.langtransform import WordToWordCharTransform, WordToWordId
-from teafacto.util import ticktock
+from teafacto.util import ticktock, isstring
 
 
 def iden(x):
     return x
 
+
+class FeedsMakerCache(object):
+    """
+    Binary cache of the parsed and id-mapped data of a feeds maker, stored as .npy files
+    that are memory-mapped when loaded, next to its source file or in cachedir (e.g. if the data directory is read-only).
+    Cached data is only used for the same source file (mtime and size) and the same settings,
+    saving removes the cached data of older versions of the source file with the same settings.
+    """
+    def __init__(self, datapath, *settings, **kw):
+        cachedir = kw.get("cachedir", None)
+        st = os.stat(datapath)
+        key = hashlib.md5(repr((st.st_mtime, st.st_size))).hexdigest()
+        if cachedir is None:
+            self.dir, name = os.path.split(os.path.abspath(datapath))
+        else:   # source files with the same name share cachedir
+            self.dir = cachedir
+            name = "%s.%s" % (os.path.basename(datapath), hashlib.md5(os.path.abspath(datapath)).hexdigest()[:8])
+        self.stem = "%s.cache.%s." % (name, hashlib.md5(repr(settings)).hexdigest())
+        self.prefix = os.path.join(self.dir, self.stem + key)
+
+    def load(self, *names):     # returns the memory-mapped arrays or None if not cached
+        paths = [self._path(name) for name in names]
+        if not all([os.path.exists(path) for path in paths]):
+            return None
+        try:
+            return [np.load(path, mmap_mode="r") for path in paths]
+        except (IOError, OSError):      # removed in the meantime by another process that saved a newer version
+            return None
+
+    def save(self, **arrays):
+        if not os.path.isdir(self.dir):
+            os.makedirs(self.dir)
+        for name in arrays:
+            tmppath = self._path(name) + ".tmp"
+            with open(tmppath, "wb") as f:
+                np.save(f, arrays[name])
+            os.rename(tmppath, self._path(name))    # never leaves a partially written array
+        for fname in os.listdir(self.dir):      # stale entries
+            if fname.startswith(self.stem) and fname.endswith(".npy") \
+                    and not os.path.join(self.dir, fname).startswith(self.prefix + "."):     # older source version
+                os.remove(os.path.join(self.dir, fname))
+
+    def _path(self, name):
+        return "%s.%s.npy" % (self.prefix, name)
+
+
+def memmapfeed(x):     # cached data is not copied by splits and batches
+    return MemmapDataFeed(x) if isinstance(x, np.memmap) else x
+
+
+def dictdigest(d):
+    return hashlib.md5(repr(sorted(d.items()))).hexdigest()
+
+
+def feedsmakercache(cache, datapath, *settings):    # cache argument of the feeds makers: True or a cache directory
+    return FeedsMakerCache(datapath, *settings, cachedir=cache if isstring(cache) else None)
+
 class FBSeqFeedsMaker(object):  #simple feed maker transforms words to idxs
-    def __init__(self, datapath, entdic, worddic, unkentid=0, numwords=10):
+    def __init__(self, datapath, entdic, worddic, unkentid=0, numwords=10, cache=False):
         self.path = datapath
         self.trainingdata = []
         self.golddata = []
         self.numwords = numwords
         self.unkentid = unkentid
         self.worddic = worddic
+        self.cache = cache
         self.load(entdic)
 
     def load(self, entdic):
+        cache = None
+        if self.cache:
+            cache = feedsmakercache(self.cache, self.path, self.__class__.__name__, self.numwords, self.unkentid,
+                                    dictdigest(self.worddic))
+            cached = cache.load("train", "gold")
+            if cached is not None:
+                self.trainingdata, self.golddata = cached
+                return
         self.trainingdata = []
         self.golddata = []
         tt = ticktock(self.__class__.__name__)
@@ -39,16 +107,18 @@ class FBSeqFeedsMaker(object):  #simple feed maker transforms words to idxs
                     tt.tock("%.0fM" % (c/1e6)).tick()
                 c += 1
         self.golddata = np.asarray(self.golddata, dtype="int32")
-        self.trainingdata = np.array(self.trainingdata)
+        t = WordToWordId(numwords=self.numwords, worddic=self.worddic)
+        self.trainingdata = t.transform(np.array(self.trainingdata))    # words looked up once
+        if cache is not None:
+            cache.save(train=self.trainingdata, gold=self.golddata)
 
     @property
     def trainfeed(self):
-        t = WordToWordId(numwords=self.numwords, worddic=self.worddic)
-        return WordSeqFeed(self.trainingdata, t)
+        return memmapfeed(self.trainingdata)    # already np array of int32 word ids
 
     @property
     def goldfeed(self):
-        return self.golddata    # already np array of int32
+        return memmapfeed(self.golddata)    # already np array of int32
 
     @staticmethod
     def _process_sf(sf, numwords):
@@ -65,7 +135,7 @@ class FBSeqFeedsMaker(object):  #simple feed maker transforms words to idxs
 
 
 class FreebaseEntFeedsMaker(object):
-    def __init__(self, datapath, worddic, entdic, numwords=10, numchars=30, unkwordid=1, unkentid=0):
+    def __init__(self, datapath, worddic, entdic, numwords=10, numchars=30, unkwordid=1, unkentid=0, cache=False):
         self.path = datapath
         self.trainingdata = []
         self.golddata = []
@@ -74,9 +144,20 @@ class FreebaseEntFeedsMaker(object):
         self.numchars = numchars
         self.unkwordid = unkwordid
         self.unkentid = unkentid
+        self.cache = cache
         self.load(entdic)
 
-    def load(self, entdic):
+    def load(self, entdic):     # with cache, trainingdata is a RaggedFeed of the transformed words instead of the words
+        cache = None
+        if self.cache:
+            cache = feedsmakercache(self.cache, self.path, self.__class__.__name__, self.numwords, self.numchars,
+                                    self.unkwordid, self.unkentid, dictdigest(self.worddic), dictdigest(entdic))
+            cached = cache.load("trainvalues", "trainwordoffsets", "traincharoffsets", "gold")
+            if cached is not None:
+                values, wordoffsets, charoffsets, self.golddata = cached
+                self.trainingdata = RaggedFeed(values, [wordoffsets, charoffsets],
+                                               shape=self.transformer.getshapefor((wordoffsets.shape[0] - 1,)))
+                return
         self.trainingdata = []
         self.golddata = []
         tt = ticktock(self.__class__.__name__)
@@ -97,15 +178,25 @@ class FreebaseEntFeedsMaker(object):
                 c += 1
         self.golddata = np.asarray(self.golddata, dtype="int32")
         self.trainingdata = np.array(self.trainingdata)
+        if cache is not None:
+            self.trainingdata = RaggedFeed.fromdense(WordSeqFeed(self.trainingdata, self.transformer))
+            wordoffsets, charoffsets = self.trainingdata.offsets
+            cache.save(trainvalues=self.trainingdata.data, trainwordoffsets=wordoffsets,
+                       traincharoffsets=charoffsets, gold=self.golddata)
+
+    @property
+    def transformer(self):
+        return WordToWordCharTransform(self.worddic, unkwordid=self.unkwordid, numwords=self.numwords, numchars=self.numchars)
 
     @property
     def trainfeed(self):
-        t = WordToWordCharTransform(self.worddic, unkwordid=self.unkwordid, numwords=self.numwords, numchars=self.numchars)
-        return WordSeqFeed(self.trainingdata, t)
+        if isinstance(self.trainingdata, RaggedFeed):   # already transformed
+            return self.trainingdata
+        return WordSeqFeed(self.trainingdata, self.transformer)
 
     @property
     def goldfeed(self):
-        return self.golddata    # already np array of int32
+        return memmapfeed(self.golddata)    # already np array of int32
 
     @staticmethod
     def _process_sf(sf, numwords, numchars):
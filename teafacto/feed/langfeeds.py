@@ -1,32 +1,45 @@
 import numpy as np
 
-from teafacto.core.datafeed import DataFeed
+from teafacto.core.datafeed import IdxViewFeed
 from teafacto.core.datafeed import FeedTransform
+from teafacto.feed.langtransform import WordTableTransform
 
 
-class WordSeqFeed(DataFeed):
-    def __init__(self, data, transformer=FeedTransform(), **kw):
-        super(WordSeqFeed, self).__init__(data, **kw)
+class WordSeqFeed(IdxViewFeed):
+    _ids = None     # table rows of all data, for WordTableTransforms
+
+    def __init__(self, data, transformer=FeedTransform(), idxs=None, **kw):
+        super(WordSeqFeed, self).__init__(data, idxs=idxs, **kw)
         self.transformer = transformer
 
     @property
     def dtype(self):
         return np.dtype("int32")
 
-    @property
-    def ndim(self):
-        return len(self.shape)
-
     @property
     def shape(self):
-        return self.transformer.getshapefor(self.data.shape)
-
-    def __getitem__(self, item):
+        shape = self.transformer.getshapefor(self.data.shape)
+        if self.idxs is None:
+            return shape
+        return (self.idxs.shape[0],) + tuple(shape[1:])
+
+    def _gather(self, item):
+        if isinstance(self.transformer, WordTableTransform):    # words are looked up once, batches are gathered
+            return self.transformer.gather(self.ids[item])
         ret = self.data.__getitem__(item)
         return self.transform(ret)
 
-    def get(self, idxs): # should return datafeed of the same type TODO write test
-        return self.__class__(self.data[idxs], self.transformer)
+    @property
+    def ids(self):
+        if self._ids is None:
+            self._ids = self.transformer.index(self.data)
+        return self._ids
+
+    def get(self, idxs): # view sharing data (and looked up table rows) with this feed
+        ret = self.__class__(self.data, self.transformer, idxs=self._subidxs(idxs))
+        if isinstance(self.transformer, WordTableTransform):
+            ret._ids = self.ids
+        return ret
 
     def transform(self, x):
         return self.transformer.transform(x)
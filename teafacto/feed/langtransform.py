@@ -4,60 +4,75 @@ from collections import OrderedDict
 from teafacto.core.datafeed import FeedTransform
 
 
-class WordToWordId(FeedTransform):
-    def __init__(self, worddic, numwords=10, **kw):
-        super(WordToWordId, self).__init__(**kw)
-        self.worddic = worddic
+class WordTableTransform(FeedTransform):
+    """
+    Transforms batches of word sequences (arrays of words, None for missing words) by gathering
+    from a table with one precomputed row per unique word, so the string work is done once per word.
+    Everything after the first missing word of a sequence is zeros.
+    """
+    def __init__(self, numwords=10, **kw):
+        super(WordTableTransform, self).__init__(**kw)
         self.numwords = numwords
+        self._wordids = {}      # word ==> table row
+        self._rows = [self._zerorow()]    # row 0: missing word
+        self._table = None
 
     def getshapefor(self, datashape):
-        return (datashape[0], self.numwords)
-
-    def transform(self, x):     # x is batch of lists of words
-        ret = np.zeros((x.shape[0], self.numwords), dtype="int32")
-        i = 0
-        while i < x.shape[0]:
-            j = 0
-            while j < x.shape[1]:
-                word = x[i, j]
-                if word is None:
-                    j = x.shape[1]  #skip
-                else:
-                    ret[i, j] = self.worddic[word.lower()]
-                j += 1
-            i += 1
-        return ret
-
-
-class WordToWordCharTransform(FeedTransform):
+        return (datashape[0], self.numwords) + self._zerorow().shape
+
+    def transform(self, x):
+        return self.gather(self.index(x))
+
+    def index(self, x):     # words (batsize, seqlen) ==> table rows int32 (batsize, numwords)
+        ids = np.zeros((x.shape[0], self.numwords), dtype="int32")
+        ids[:, :x.shape[1]] = np.asarray([self._wordid(word) for word in x.flat], dtype="int32").reshape(x.shape)
+        return ids * np.cumprod(ids > 0, axis=1)    # skip after first missing word
+
+    def gather(self, ids):  # table rows ==> transformed words
+        if self._table is None or self._table.shape[0] < len(self._rows):
+            self._table = np.asarray(self._rows, dtype="int32")
+        return self._table[ids]
+
+    def _wordid(self, word):
+        if word is None:
+            return 0
+        if word not in self._wordids:
+            self._wordids[word] = len(self._rows)
+            self._rows.append(self._wordrow(word))
+        return self._wordids[word]
+
+    def _zerorow(self):
+        raise NotImplementedError("use subclass")
+
+    def _wordrow(self, word):
+        raise NotImplementedError("use subclass")
+
+
+class WordToWordId(WordTableTransform):
+    def __init__(self, worddic, numwords=10, unkwordid=1, **kw):
+        self.worddic = worddic
+        self.unkwordid = unkwordid
+        super(WordToWordId, self).__init__(numwords=numwords, **kw)
+
+    def _zerorow(self):     # word id
+        return np.zeros((), dtype="int32")
+
+    def _wordrow(self, word):
+        return self.worddic.get(word.lower(), self.unkwordid)
+
+
+class WordToWordCharTransform(WordTableTransform):
     def __init__(self, worddic, unkwordid=1, numwords=10, numchars=30, **kw):
-        super(WordToWordCharTransform, self).__init__(**kw)
         self.worddic = worddic
         self.unkwordid = unkwordid
-        self.numwords = numwords
         self.numchars = numchars
+        super(WordToWordCharTransform, self).__init__(numwords=numwords, **kw)
 
-    def getshapefor(self, datashape):
-        return (datashape[0], self.numwords, self.numchars + 1)
+    def _zerorow(self):     # word id + char ids
+        return np.zeros((self.numchars + 1,), dtype="int32")
 
-    def transform(self, x):
-        ret = np.zeros((x.shape[0], self.numwords, self.numchars + 1), dtype="int32")
-        i = 0
-        while i < x.shape[0]:
-            j = 0
-            while j < x.shape[1]:
-                word = x[i, j]
-                retword, skip = transinner((word, self.numchars, self.worddic, self.unkwordid))
-                if max(retword[1:]) > 128:
-                    print x
-                if skip:
-                    j = x.shape[1]
-                else:
-                    ret[i, j, :] = retword
-                j += 1
-
-            i += 1
-        return ret
+    def _wordrow(self, word):
+        return transinner((word, self.numchars, self.worddic, self.unkwordid))[0]
 
 
 def transinner(args):
@@ -76,6 +91,6 @@ def transinner(args):
             retword = [worddic[word]]      # get word index
         else:
             retword = [unkwordid]                       # unknown word
-        retword.extend(map(ord, word))
+        retword.extend(map(ord, word[:numchars-1]))
         retword.extend([0]*(numchars-len(retword)))
     return retword, skip #np.asarray(retword, dtype="int32")
\ No newline at end of file
@@ -3,6 +3,7 @@ from math import ceil
 import numpy as np
 import theano
 from teafacto.core.trainutil import SGDBase, Saveable, Profileable, Normalizable, Predictor, uniform
+from teafacto.core.datafeed import CorruptedFeed
 from theano import tensor as T
 
 from blocks.rnn import RNUBase
@@ -85,15 +86,13 @@ class KMM(SGDBase, Predictor, Profileable, Saveable):
         batsize = self.batsize if not onebatch else data.shape[0]
         negrate = self.negrate
 
+        corrupted = CorruptedFeed(labels, numids=self.vocabsize, negrate=negrate)
+
         def samplegen():
-            nonzeroidx = sorted(np.random.randint(0, data.shape[0], size=(batsize,)).astype("int32"))
-            trainXsample = data[nonzeroidx, :].astype("int32")
-            trainXsample = np.repeat(trainXsample, negrate, axis=0)
-            labelsample = labels[nonzeroidx].astype("int32")
-            labelsample = np.repeat(labelsample, negrate, axis=0)
-            corruptedlabels = np.random.randint(0, self.vocabsize, size=(batsize,)).astype("int32")
-            for i in range(negrate-1):
-                corruptedlabels = np.append(corruptedlabels, np.random.randint(0, self.vocabsize, size=(batsize,)).astype("int32"), axis=0)
+            sampleidxs = np.random.randint(0, data.shape[0], size=(batsize,))
+            trainXsample = np.repeat(data[sampleidxs, :].astype("int32"), negrate, axis=0)
+            labelsample = np.repeat(labels[sampleidxs].astype("int32"), negrate, axis=0)
+            corruptedlabels = corrupted[sampleidxs].astype("int32").flatten()
             return [trainXsample[:, 0], trainXsample[:, 1:], labelsample, corruptedlabels]     # start, path, target, bad_target
         return samplegen
 
@@ -182,6 +182,81 @@ class TestIFGRUnobias(TestIFGRU, TestGRUnobias):
         self.assertEqual(self.rnu.uif.shape, (self.innerdim, self.dim))
 
 
+class TestGRUPrecompute(TestGRU):
+    def makernu(self):
+        return GRU(dim=self.dim, innerdim=self.innerdim).precompute
+
+    def makeplainrnu(self):
+        return GRU(dim=self.dim, innerdim=self.innerdim)
+
+    def test_same_as_plain(self):
+        plain = self.makeplainrnu()
+        for paramname in self.paramnames:
+            getattr(plain, paramname).value.set_value(getattr(self.rnu, paramname).value.get_value())
+        self.assertTrue(np.allclose(self.rnu.predict(self.testdata), plain.predict(self.testdata)))
+
+
+class TestLSTMPrecompute(TestLSTM, TestGRUPrecompute):
+    def makernu(self):
+        return LSTM(dim=self.dim, innerdim=self.innerdim).precompute
+
+    def makeplainrnu(self):
+        return LSTM(dim=self.dim, innerdim=self.innerdim)
+
+
+class TestIFGRUPrecompute(TestIFGRU, TestGRUPrecompute):
+    def makernu(self):
+        return IFGRU(dim=self.dim, innerdim=self.innerdim).precompute
 
+    def makeplainrnu(self):
+        return IFGRU(dim=self.dim, innerdim=self.innerdim)
+
+
+class TestGRUFused(TestGRU):
+    def makernu(self):
+        return GRU(dim=self.dim, innerdim=self.innerdim, fused=True)
+
+    def getparamnames(self):
+        return ["um_uhf", "wm", "whf", "u", "w", "bm", "bhf", "b"]
+
+    def getuparamnames(self):
+        return ["u"]
+
+    def test_fused_param_shape(self):
+        self.assertEqual(self.rnu.um_uhf.shape, (self.innerdim, 2*self.innerdim))
+        self.assertFalse(hasattr(self.rnu, "um"))
+
+    def test_same_as_unfused(self):
+        plain = self.rnu.__class__(dim=self.dim, innerdim=self.innerdim)
+        fused = plain.__class__.unfreeze(plain.freeze()).fuse()
+        plainpred = plain.predict(self.testdata)
+        fusedpred = fused.predict(self.testdata)
+        self.assertTrue(np.allclose(plainpred, fusedpred))
+
+    def test_unfuse(self):
+        unfused = self.rnu.__class__.unfreeze(self.rnu.freeze()).unfuse()
+        fusedpred = self.rnu.predict(self.testdata)
+        for paramname in self.getuparamnames():
+            self.assertEqual(getattr(unfused, paramname).shape, self.ushape)
+        self.assertTrue(np.allclose(fusedpred, unfused.predict(self.testdata)))
+
+
+class TestLSTMFused(TestLSTM, TestGRUFused):
+    def makernu(self):
+        return LSTM(dim=self.dim, innerdim=self.innerdim, fused=True)
+
+    def getparamnames(self):
+        return ["wf", "bf", "wi", "bi", "wo", "bo", "w", "b", "pf", "pi", "po", "rf_ri_r_ro"]
+
+    def getuparamnames(self):
+        return []
 
+    def test_fused_param_shape(self):
+        self.assertEqual(self.rnu.rf_ri_r_ro.shape, (self.innerdim, 4*self.innerdim))
+        self.assertFalse(hasattr(self.rnu, "rf"))
 
+    def test_unfuse(self):
+        unfused = self.rnu.__class__.unfreeze(self.rnu.freeze()).unfuse()
+        fusedpred = self.rnu.predict(self.testdata)
+        self.assertEqual(unfused.ro.shape, self.ushape)
+        self.assertTrue(np.allclose(fusedpred, unfused.predict(self.testdata)))
@@ -48,6 +48,23 @@ class DummyAttentionGeneratorConsumerTest(TestCase):
         allparams = self.att.output.allparams
         self.assertSetEqual(allparams, self.attgenparams)
 
+    def test_generator_values(self):
+        pred = self.attgen.predict(self.criterion_val, self.data_val)
+        W = self.attgen.W.d.get_value()
+        expected = []
+        for t in range(self.data_val.shape[1]):    # score each position as the concatenation [x_t, crit]
+            combo = np.concatenate([self.data_val[:, t, :], self.criterion_val], axis=1)
+            expected.append(self.getexpectedscore(np.dot(combo, W)))
+        expected = self.normalizeexpected(np.stack(expected, axis=1))
+        self.assertTrue(np.allclose(pred, expected, atol=1e-6))
+
+    def getexpectedscore(self, trans):
+        return np.sum(trans, axis=1)
+
+    def normalizeexpected(self, scores):
+        e = np.exp(scores - np.max(scores, axis=1, keepdims=True))
+        return e / np.sum(e, axis=1, keepdims=True)
+
 
 class LinearAggAttentionGenTest(DummyAttentionGeneratorConsumerTest):
     def getattgenc(self):
@@ -56,6 +73,22 @@ class LinearAggAttentionGenTest(DummyAttentionGeneratorConsumerTest):
     def getattgenparams(self):
         return {self.attgen.W, self.attgen.U}
 
+    def getexpectedscore(self, trans):
+        return 1. / (1. + np.exp(-np.dot(np.tanh(trans), self.attgen.U.d.get_value())))
+
+    def normalizeexpected(self, scores):
+        return scores
+
+
+class WeightedSumAttConTest(TestCase):
+    def test_values(self):
+        data = np.random.random((33, 11, 20)).astype("float32")
+        weights = np.random.random((33, 11)).astype("float32")
+        pred = WeightedSumAttCon().predict(data, weights)
+        expected = np.sum(data * weights[:, :, np.newaxis], axis=1)
+        self.assertEqual(pred.shape, (33, 20))
+        self.assertTrue(np.allclose(pred, expected, atol=1e-5))
+
 
 class TestAttentionRNNDecoder(TestCase):
     def setUp(self):
@@ -98,3 +131,10 @@ class TestAttentionRNNDecoder(TestCase):
         self.decwoatt.predict(self.data, self.seqdata)
         allparams = self.decwoatt.output.allparams
         self.assertNotIn(self.att.attentiongenerator.W, allparams)
+
+    def test_precomputed_ctx_same_as_per_step(self):
+        pred = self.decwatt.predict(self.attdata, self.seqdata)
+        self.decwatt._precompute_ctx = lambda ctx: None     # project context inside every decoder step
+        self.decwatt._predictf = None
+        perstep = self.decwatt.predict(self.attdata, self.seqdata)
+        self.assertTrue(np.allclose(pred, perstep, atol=1e-6))
@@ -1,5 +1,308 @@
 from unittest import TestCase
+import numpy as np, os, shutil, tempfile
+from teafacto.core.datafeed import DataFeeder, PrefetchDataFeeder, MemmapDataFeed, IdxViewFeed, SplitIdxIterator, RaggedFeed, CorruptedFeed
 
 
 class TestDataFeeder(TestCase):
-    pass
+    def setUp(self):
+        self.x = np.random.random((103, 4))
+        self.y = np.arange(0, 103)
+
+    def test_splits_are_views(self):
+        df = DataFeeder(self.x, self.y)
+        for tf, vf in [df.split(5, random=True), df.isplit(np.asarray([10, 2, 30]))]:
+            self.assertEqual(tf.size + vf.size, df.size)
+            for split in [tf, vf]:
+                x, y = split.feeds
+                self.assertIsInstance(x, IdxViewFeed)
+                self.assertIs(x.data, self.x)
+                self.assertIs(y.data, self.y)
+                self.assertTrue(np.all(x[:] == self.x[y[:]]))   # examples stay aligned
+            self.assertEqual(sorted(np.concatenate([tf.feeds[1][:], vf.feeds[1][:]])), range(103))
+
+    def test_nested_views(self):
+        _, vf = DataFeeder(self.x, self.y).isplit(np.asarray([10, 2, 30, 50]))
+        _, vvf = vf.isplit(np.asarray([3, 1]))
+        self.assertIs(vvf.feeds[0].data, self.x)
+        self.assertTrue(np.all(vvf.feeds[1][:] == [50, 2]))
+        self.assertTrue(np.all(vvf.feeds[0][np.asarray([1])] == self.x[[2]]))
+        self.assertEqual(vvf.feeds[0].shape, (2, 4))
+        self.assertEqual(vvf.feeds[0].ndim, 2)
+
+    def test_cross_valid_folds_are_views(self):
+        df = DataFeeder(self.x, self.y)
+        seen = []
+        for splitidxs in SplitIdxIterator(df.size, split=5, folds=5):
+            tf, vf = df.isplit(splitidxs)
+            self.assertIs(tf.feeds[0].data, self.x)
+            seen.extend(vf.feeds[1][:])
+            batches = []
+            while tf.numbats(4).hasnextbatch():
+                batches.append(tf.nextbatch())
+            self.assertEqual(sum([b[0].shape[0] for b in batches]), tf.size)
+        self.assertEqual(sorted(seen), range(103))
+
+
+class TestBucketedDataFeeder(TestCase):
+    def setUp(self):
+        np.random.seed(1337)
+        self.lens = np.random.randint(0, 8, (103,))
+        self.x = np.zeros((103, 20, 3), dtype="int32")
+        for i, l in enumerate(self.lens):
+            self.x[i, :l] = np.random.randint(1, 10, (l, 3))
+            if l > 1:
+                self.x[i, 0] = 0    # zero positions before the end are not padding
+        self.y = np.arange(0, 103)
+
+    def epoch(self, df):
+        ret = []
+        while df.hasnextbatch():
+            ret.append(df.nextbatch())
+        return ret
+
+    def test_seqlens(self):
+        self.assertTrue(np.all(DataFeeder.seqlens(self.x, chunksize=10) == self.lens))
+        self.assertTrue(np.all(DataFeeder.seqlens(self.x[:, :, 0]) <= self.lens))
+
+    def test_batches_trimmed(self):
+        df = DataFeeder(self.x, self.y).numbats(10).bucketed()
+        batches = self.epoch(df)
+        self.assertEqual(len(batches), 10)
+        for x, y in batches:
+            self.assertEqual(x.shape[1], max(np.max(self.lens[y]), 1))
+            self.assertTrue(np.all(x == self.x[y][:, :x.shape[1]]))
+            self.assertTrue(np.all(self.x[y][:, x.shape[1]:] == 0))     # only padding was trimmed
+        lenranges = sorted([(np.min(self.lens[y]), np.max(self.lens[y])) for _, y in batches])
+        for (_, prevmax), (nextmin, _) in zip(lenranges[:-1], lenranges[1:]):   # batches are slices of the sorted examples
+            self.assertLessEqual(prevmax, nextmin)
+        self.assertEqual(sorted(np.concatenate([y for _, y in batches])), range(103))
+
+    def test_smaller_batch_random(self):
+        df = DataFeeder(self.x, self.y).numbats(10).bucketed()
+        lastlens = set()
+        for i in range(10):
+            batches = self.epoch(df)
+            self.assertEqual([len(y) for _, y in batches], [11] * 9 + [4])
+            lastlens.add(tuple(sorted(self.lens[batches[-1][1]])))
+        self.assertGreater(len(lastlens), 1)
+        df = DataFeeder(self.x, self.y)
+        df.random = False
+        batches = self.epoch(df.numbats(10).bucketed())
+        self.assertTrue(np.all(self.lens[batches[-1][1]] == np.sort(self.lens)[-4:]))    # not random: the longest
+
+    def test_random_across_epochs(self):
+        df = DataFeeder(self.x, self.y).bucketed().numbats(10)    # settings in any order
+        first = [y for _, y in self.epoch(df)]
+        second = [y for _, y in self.epoch(df)]
+        self.assertEqual(len(first), 10)
+        self.assertFalse(all([np.all(a == b) for a, b in zip(first, second)]))
+        self.assertEqual(sorted(np.concatenate(second)), range(103))
+
+    def test_unbatched(self):
+        x, y = DataFeeder(self.x, self.y).bucketed().nextbatch()
+        self.assertEqual(x.shape, (103, np.max(self.lens), 3))
+
+
+class TestRaggedFeed(TestCase):
+    def setUp(self):
+        np.random.seed(1337)
+        self.x = np.zeros((103, 6, 5), dtype="int32")
+        for i in range(self.x.shape[0]):
+            for j in range(np.random.randint(0, 7)):
+                l = np.random.randint(0, 6)
+                self.x[i, j, :l] = np.random.randint(1, 9, (l,))
+        self.x[3, 1, :] = [0, 4, 0, 2, 0]     # zeros before the end are kept
+        self.feed = RaggedFeed.fromdense(self.x, chunksize=10)
+
+    def test_storage(self):
+        self.assertEqual(self.feed.shape, self.x.shape)
+        self.assertEqual(self.feed.dtype, self.x.dtype)
+        self.assertEqual(len(self.feed.offsets), 2)
+        self.assertEqual(self.feed.offsets[0].shape, (104,))
+        self.assertEqual(np.sum(self.feed.data != 0), np.sum(self.x != 0))
+        self.assertLess(self.feed.data.size, self.x.size / 2)
+
+    def test_getitem(self):
+        idxs = np.asarray([5, 3, 99, 3])
+        self.assertTrue(np.all(self.feed[:] == self.x))
+        self.assertTrue(np.all(self.feed[idxs] == self.x[idxs]))
+        self.assertTrue(np.all(self.feed[10:20] == self.x[10:20]))
+        self.assertTrue(np.all(self.feed[3] == self.x[3]))
+
+    def test_views(self):
+        dftrain, dfvalid = DataFeeder(self.feed, np.arange(0, 103)).isplit(np.asarray([7, 3, 50]))
+        self.assertIsInstance(dfvalid.feeds[0], RaggedFeed)
+        self.assertIs(dfvalid.feeds[0].data, self.feed.data)
+        self.assertEqual(dftrain.feeds[0].shape, (100, 6, 5))
+        while dftrain.numbats(7).hasnextbatch():
+            x, y = dftrain.nextbatch()
+            self.assertTrue(np.all(x == self.x[y]))
+
+    def test_truncates_to_shape(self):
+        feed = RaggedFeed(self.feed.data, self.feed.offsets, shape=(103, 3, 2))
+        self.assertTrue(np.all(feed[:] == self.x[:, :3, :2]))
+
+    def test_one_level(self):
+        x = self.x[:, :, 0]
+        feed = RaggedFeed.fromdense(x)
+        self.assertEqual(len(feed.offsets), 1)
+        self.assertTrue(np.all(feed[:] == x))
+
+
+class TestCorruptedFeed(TestCase):
+    def setUp(self):
+        self.x = np.random.randint(0, 50, (103, 4)).astype("int32")    # paths: subject, relations, object
+
+    def test_corrupts_one_position(self):
+        feed = CorruptedFeed(self.x, numids=50, negrate=3)
+        self.assertEqual(feed.shape, (103, 3, 4))
+        neg = feed[np.asarray([5, 1, 5])]
+        self.assertEqual(neg.shape, (3, 3, 4))
+        self.assertEqual(neg.dtype, self.x.dtype)
+        self.assertTrue(np.all(neg[:, :, :-1] == self.x[[5, 1, 5]][:, None, :-1]))
+        self.assertFalse(np.all(feed[:] == feed[:]))   # new negatives every batch
+
+    def test_corrupts_random_positions(self):
+        neg = CorruptedFeed(self.x, numids=50, negrate=20, corrupt=(0, 3))[:]
+        changed = neg != self.x[:, None, :]
+        self.assertTrue(np.all(changed[:, :, 1:3] == False))
+        self.assertLessEqual(np.max(np.sum(changed, axis=2)), 1)
+        self.assertTrue(np.any(changed[:, :, 0]) and np.any(changed[:, :, 3]))
+
+    def test_ids(self):
+        neg = CorruptedFeed(self.x[:, -1], numids=50, negrate=5)[:]
+        self.assertEqual(neg.shape, (103, 5))
+        self.assertTrue(np.all((neg >= 0) & (neg < 50)))
+
+    def test_freqs(self):
+        freqs = np.zeros((50,))
+        freqs[[3, 7]] = [1, 3]
+        neg = CorruptedFeed(self.x, negrate=50, freqs=freqs)[:][:, :, -1]
+        self.assertEqual(set(np.unique(neg)), {3, 7})
+        self.assertAlmostEqual(np.mean(neg == 7), 0.75, places=1)
+
+    def test_in_datafeeder(self):
+        df = DataFeeder(self.x, CorruptedFeed(self.x, numids=50, negrate=2, corrupt=(0,)))
+        _, vf = df.isplit(np.asarray([7, 3, 50]))
+        self.assertIsInstance(vf.feeds[1], CorruptedFeed)
+        self.assertEqual(vf.feeds[1].shape, (3, 2, 4))
+        while df.numbats(10).hasnextbatch():
+            pos, neg = df.nextbatch()
+            self.assertTrue(np.all(neg[:, :, 1:] == pos[:, None, 1:]))
+
+
+class TestMemmapDataFeed(TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.x = np.random.randint(0, 100, (103, 4)).astype("int32")
+        self.path = os.path.join(self.tmpdir, "x.npy")
+        np.save(self.path, self.x)
+        self.feed = MemmapDataFeed(self.path)
+
+    def tearDown(self):
+        del self.feed
+        shutil.rmtree(self.tmpdir)
+
+    def test_is_memmapped(self):
+        self.assertIsInstance(self.feed.data, np.memmap)
+        self.assertEqual(self.feed.shape, self.x.shape)
+        self.assertEqual(self.feed.dtype, self.x.dtype)
+
+    def test_getitem(self):
+        idxs = np.asarray([5, 1, 99, 1, 0])
+        self.assertTrue(np.all(self.feed[idxs] == self.x[idxs]))
+        self.assertTrue(np.all(self.feed[3:7] == self.x[3:7]))
+        self.assertTrue(np.all(self.feed[:] == self.x))
+        self.assertNotIsInstance(self.feed[idxs], np.memmap)
+
+    def test_split_is_view(self):
+        dftrain, dfvalid = DataFeeder(self.feed).isplit(np.asarray([7, 3, 50]))
+        validfeed, trainfeed = dfvalid.feeds[0], dftrain.feeds[0]
+        self.assertIs(validfeed.data, self.feed.data)
+        self.assertIs(trainfeed.data, self.feed.data)
+        self.assertEqual(validfeed.shape, (3, 4))
+        self.assertEqual(trainfeed.shape, (100, 4))
+        self.assertTrue(np.all(validfeed[:] == self.x[[7, 3, 50]]))
+        self.assertTrue(np.all(validfeed[np.asarray([2, 0])] == self.x[[50, 7]]))
+        subfeed = validfeed.get(np.asarray([1, 2]))
+        self.assertIs(subfeed.data, self.feed.data)
+        self.assertTrue(np.all(subfeed[:] == self.x[[3, 50]]))
+
+    def test_batches(self):
+        np.random.seed(1337)
+        expected = [b[0] for b in TestPrefetchDataFeeder.epochs(DataFeeder(self.x).numbats(10), 1)[0]]
+        np.random.seed(1337)
+        batches = [b[0] for b in TestPrefetchDataFeeder.epochs(DataFeeder(self.feed).numbats(10), 1)[0]]
+        self.assertEqual(len(batches), len(expected))
+        for batch, expectedbatch in zip(batches, expected):
+            self.assertTrue(np.all(batch == expectedbatch))
+
+
+class TestPrefetchDataFeeder(TestCase):
+    def setUp(self):
+        self.x = np.arange(0, 103)
+        self.y = np.random.random((103, 3))
+
+    @staticmethod
+    def epochs(feeder, numepochs=3):
+        ret = []
+        for i in range(numepochs):
+            epoch = []
+            while feeder.hasnextbatch():
+                epoch.append(feeder.nextbatch())
+            ret.append(epoch)
+        return ret
+
+    def test_same_batches(self):
+        np.random.seed(1337)
+        expected = self.epochs(DataFeeder(self.x, self.y).numbats(10))
+        np.random.seed(1337)
+        prefetcher = PrefetchDataFeeder(DataFeeder(self.x, self.y), prefetch=3).numbats(10)
+        batches = self.epochs(prefetcher)
+        prefetcher.close()
+        self.assertEqual(len(batches), len(expected))
+        for epoch, expectedepoch in zip(batches, expected):
+            self.assertEqual(len(epoch), len(expectedepoch))
+            for batch, expectedbatch in zip(epoch, expectedepoch):
+                for feed, expectedfeed in zip(batch, expectedbatch):
+                    self.assertTrue(np.all(feed == expectedfeed))
+
+    def test_independent_of_global_random(self):     # the thread does not draw from np.random
+        np.random.seed(1337)
+        expected = self.epochs(DataFeeder(self.x, CorruptedFeed(self.x, numids=50)).numbats(10))
+        np.random.seed(1337)
+        prefetcher = PrefetchDataFeeder(DataFeeder(self.x, CorruptedFeed(self.x, numids=50)), prefetch=3).numbats(10)
+        batches = []
+        for i in range(3):
+            epoch = []
+            while prefetcher.hasnextbatch():
+                epoch.append(prefetcher.nextbatch())
+                np.random.random()      # e.g. sampling in the training loop
+            batches.append(epoch)
+        prefetcher.close()
+        for epoch, expectedepoch in zip(batches, expected):
+            for batch, expectedbatch in zip(epoch, expectedepoch):
+                for feed, expectedfeed in zip(batch, expectedbatch):
+                    self.assertTrue(np.all(feed == expectedfeed))
+
+    def test_numbats_restarts_epoch(self):
+        prefetcher = PrefetchDataFeeder(DataFeeder(self.x, self.y), prefetch=3).numbats(10)
+        prefetcher.hasnextbatch()
+        prefetcher.nextbatch()
+        epoch = self.epochs(prefetcher.numbats(5), 1)[0]
+        prefetcher.close()
+        self.assertEqual(len(epoch), 5)
+        self.assertEqual(sorted(np.concatenate([batch[0] for batch in epoch]).tolist()), self.x.tolist())
+
+    def test_delegates_settings(self):
+        prefetcher = PrefetchDataFeeder(DataFeeder(self.x, self.y)).numbats(10)
+        self.assertEqual(prefetcher._numbats, 10)
+        self.assertEqual(prefetcher.size, 103)
+
+    def test_raises_errors_of_thread(self):
+        class FailingFeed(object):
+            shape = (103,)
+            def __getitem__(self, item):
+                raise ValueError()
+        prefetcher = PrefetchDataFeeder(DataFeeder(self.x, FailingFeed())).numbats(10)
+        self.assertRaises(ValueError, prefetcher.hasnextbatch)
@@ -0,0 +1,141 @@
+from unittest import TestCase
+
+import numpy as np, os, shutil, tempfile, warnings
+import theano
+from theano import tensor
+
+from teafacto.examples.dummy import *
+from teafacto.core.fncache import fncache, FunctionCache, TieredFunction
+
+
+class TestFunctionCache(TestCase):
+    def setUp(self):
+        self.vocabsize = 100
+        self.data = np.arange(0, self.vocabsize).astype("int32")
+        self.tmpdir = tempfile.mkdtemp()
+        self.oldpath, self.oldenabled = fncache.path, fncache.enabled
+        fncache.purge()
+        fncache.enable(self.tmpdir)
+
+    def tearDown(self):
+        fncache.path, fncache.enabled = self.oldpath, self.oldenabled
+        fncache.hits, fncache.misses, fncache.savefailures = 0, 0, 0
+        shutil.rmtree(self.tmpdir)
+
+    def test_disabled_by_default(self):
+        self.assertFalse(FunctionCache().enabled)
+
+    def test_predict_hit(self):
+        first = Dummy(indim=self.vocabsize, dim=10)
+        firstpred = first.predict(self.data)
+        self.assertEqual(fncache.stats, {"hits": 0, "misses": 1, "savefailures": 0, "entries": 1})
+        second = Dummy(indim=self.vocabsize, dim=10)
+        secondpred = second.predict(self.data)
+        self.assertEqual(fncache.stats, {"hits": 1, "misses": 1, "savefailures": 0, "entries": 1})
+        self.assertFalse(np.allclose(firstpred, secondpred))    # loaded function uses the params of second
+        fncache.disable()
+        uncached = Dummy.unfreeze(second.freeze())
+        self.assertTrue(np.allclose(uncached.predict(self.data), secondpred))
+
+    def test_train_hit_updates_params(self):
+        init = Dummy(indim=self.vocabsize, dim=10)
+        models = [Dummy.unfreeze(init.freeze()) for i in range(3)]
+        for i, model in enumerate(models):
+            if i == 2:
+                fncache.disable()
+            np.random.seed(1)   # same batches
+            model.train([self.data], self.data).adam(lr=0.01).cross_entropy().train(numbats=5, epochs=2)
+        self.assertEqual(fncache.hits, 1)
+        self.assertFalse(np.allclose(init.O.d.get_value(), models[0].O.d.get_value()))
+        for model in models[1:]:
+            self.assertTrue(np.allclose(models[0].O.d.get_value(), model.O.d.get_value()))
+            self.assertTrue(np.allclose(models[0].W.W.d.get_value(), model.W.W.d.get_value()))
+
+    def test_different_graph_misses(self):
+        model = Dummy(indim=self.vocabsize, dim=10)
+        model.predict(self.data)
+        model.W.predict(self.data)
+        self.assertEqual(fncache.stats, {"hits": 0, "misses": 2, "savefailures": 0, "entries": 2})
+
+    def test_purge(self):
+        Dummy(indim=self.vocabsize, dim=10).predict(self.data)
+        fncache.purge()
+        self.assertEqual(fncache.stats, {"hits": 0, "misses": 0, "savefailures": 0, "entries": 0})
+        self.assertFalse(os.path.exists(self.tmpdir))
+        os.makedirs(self.tmpdir)
+
+    def test_save_failures_counted(self):
+        notadir = os.path.join(self.tmpdir, "notadir")
+        open(notadir, "w").close()
+        cache = FunctionCache(notadir, enabled=True)
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter("always")
+            x = tensor.vector()
+            f = cache.function([x], x.sum() + 1)
+        self.assertEqual(cache.stats["savefailures"], 1)
+        self.assertEqual(len(caught), 1)
+        self.assertEqual(f(np.zeros((2,), dtype=theano.config.floatX)), 1)
+
+
+class TestTieredFunction(TestCase):
+    def setUp(self):
+        self.x = tensor.matrix()
+        self.w = theano.shared(np.ones((3,), dtype=theano.config.floatX))
+        h, _ = theano.scan(lambda r, acc: tensor.tanh(acc + r * self.w),
+                           sequences=[self.x], outputs_info=[tensor.zeros((3,))])
+        self.cost = h[-1].sum()
+        self.updates = [(self.w, self.w - 0.1 * tensor.grad(self.cost, self.w))]
+        self.data = np.random.random((5, 3)).astype(theano.config.floatX)
+
+    def test_swap_keeps_shared_variables(self):
+        f = theano.function([self.x], [self.cost], updates=self.updates)
+        expected = [f(self.data)[0] for i in range(4)]
+        expectedw = self.w.get_value()
+        self.w.set_value(np.ones((3,), dtype=theano.config.floatX))
+        tiered = TieredFunction([self.x], [self.cost], self.updates)
+        self.assertFalse(tiered.optimized)
+        tmpdir = tiered._tmpdir
+        errs = [tiered(self.data)[0]]
+        tiered.wait()
+        self.assertTrue(tiered.optimized)
+        self.assertFalse(os.path.exists(tmpdir))
+        errs += [tiered(self.data)[0] for i in range(3)]
+        self.assertTrue(np.allclose(errs, expected))
+        self.assertTrue(np.allclose(self.w.get_value(), expectedw))
+
+    def test_fallback_when_not_compiled_in_background(self):
+        tmpdir = tempfile.mkdtemp()
+        notadir = os.path.join(tmpdir, "notadir")
+        open(notadir, "w").close()     # the child can not store the optimized function
+        f = theano.function([self.x], [self.cost], updates=self.updates)
+        expected = [f(self.data)[0] for i in range(2)]
+        self.w.set_value(np.ones((3,), dtype=theano.config.floatX))
+        swaps = []
+        tiered = TieredFunction([self.x], [self.cost], self.updates, cache=FunctionCache(notadir, enabled=True),
+                                onswap=lambda: swaps.append(True))
+        errs = [tiered(self.data)[0]]
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter("always")
+            tiered.wait()
+        self.assertEqual(len(caught), 1)
+        self.assertTrue(tiered.optimized)
+        self.assertEqual(swaps, [True])
+        errs.append(tiered(self.data)[0])
+        self.assertTrue(np.allclose(errs, expected))
+        shutil.rmtree(tmpdir)
+
+    def test_trainer(self):
+        vocabsize = 100
+        data = np.arange(0, vocabsize).astype("int32")
+        init = Dummy(indim=vocabsize, dim=10)
+        models = [Dummy.unfreeze(init.freeze()) for i in range(2)]
+        trainers = []
+        for i, model in enumerate(models):
+            np.random.seed(1)
+            trainer = model.train([data], data).adam(lr=0.01).cross_entropy()
+            trainer = trainer.tiered() if i == 0 else trainer
+            trainer.train(numbats=5, epochs=3)
+            trainers.append(trainer)
+        self.assertEqual(trainers[0]._tieredfuns, [])
+        self.assertTrue(np.allclose(models[0].O.d.get_value(), models[1].O.d.get_value(), atol=1e-5))
+        self.assertFalse(np.allclose(models[0].O.d.get_value(), init.O.d.get_value()))
@@ -1,7 +1,8 @@
 from unittest import TestCase
 from teafacto.feed.freebasefeeders import FreebaseEntFeedsMaker, getentdict, getglovedict, FreebaseSeqFeedMaker, FBSeqFeedsMaker
-from teafacto.core.datafeed import DataFeeder
-import os, math, numpy as np
+from teafacto.feed.langtransform import WordToWordCharTransform, WordToWordId, transinner
+from teafacto.core.datafeed import DataFeeder, DataFeed, IdxViewFeed, MemmapDataFeed, RaggedFeed
+import os, math, shutil, tempfile, numpy as np
 
 
 class TestFreebaseLexFeeder(TestCase):
@@ -39,12 +40,109 @@ class TestFreebaseLexFeeder(TestCase):
         dfeeds = dfeeder.feeds
         splitfeeds = dfsplit.feeds
         for x, y in zip(dfeeds, splitfeeds):
-            self.assertEqual(x.__class__, y.__class__)
+            if isinstance(x, DataFeed):
+                self.assertEqual(x.__class__, y.__class__)
+            else:   # numpy arrays are split into views
+                self.assertIsInstance(y, IdxViewFeed)
+            self.assertIs(y.data, x.data if isinstance(x, DataFeed) else x)
             self.assertEqual(x.ndim, y.ndim)
             self.assertEqual(y.shape[0], int(math.ceil(1.*x.shape[0]/splits)))
             for dim in range(1, len(x.shape)):
                 self.assertEqual(x.shape[dim], y.shape[dim])
 
+    def test_fb_datafeed_values(self):
+        gd, gmaxi = getglovedict(os.path.join(os.path.dirname(__file__), "../data/glove/miniglove.50d.txt"))
+        ed, emaxid = getentdict(os.path.join(os.path.dirname(__file__), "../data/freebase/entdic.small.map"), top=50)
+        dp = os.path.join(os.path.dirname(__file__), "../data/freebase/labelsrevlex.map.sample")
+        f = FreebaseEntFeedsMaker(dp, gd, ed, numwords=10, numchars=30)
+        trainfeed = f.trainfeed
+        idxs = np.asarray([7, 3, 3, 0])
+        expected = np.zeros((len(idxs), 10, 31), dtype="int32")
+        for i, idx in enumerate(idxs):
+            for j, word in enumerate(f.trainingdata[idx]):
+                if word is None:
+                    break
+                expected[i, j, :] = transinner((word, 30, gd, 1))[0]
+        self.assertTrue(np.all(trainfeed[idxs] == expected))
+        self.assertTrue(np.all(trainfeed.get(idxs)[:] == expected))
+
+
+class TestWordToWordCharTransform(TestCase):
+    def test_transform(self):
+        t = WordToWordCharTransform({"the": 2, "cat": 3}, unkwordid=1, numwords=4, numchars=3)
+        x = np.array([["The", "dog", None, "cat"], ["cat", "cats", None, None]], dtype="object")
+        expected = np.asarray([[[2, 116, 104, 101], [1, 100, 111, 103], [0, 0, 0, 0], [0, 0, 0, 0]],  # skip after None
+                               [[3, 99, 97, 116], [1, 99, 97, 116], [0, 0, 0, 0], [0, 0, 0, 0]]])
+        self.assertTrue(np.all(t.transform(x) == expected))
+        self.assertTrue(np.all(t.transform(x[:, :2]) == expected))    # padded to numwords
+        self.assertEqual(t.getshapefor(x.shape), (2, 4, 4))
+
+
+class TestFreebaseFeedsMakerCache(TestCase):
+    def setUp(self):
+        self.gd, _ = getglovedict(os.path.join(os.path.dirname(__file__), "../data/glove/miniglove.50d.txt"))
+        self.ed, _ = getentdict(os.path.join(os.path.dirname(__file__), "../data/freebase/entdic.small.map"), top=50)
+        self.tmpdir = tempfile.mkdtemp()
+        self.dp = os.path.join(self.tmpdir, "labelsrevlex.map.sample")
+        shutil.copy(os.path.join(os.path.dirname(__file__), "../data/freebase/labelsrevlex.map.sample"), self.dp)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def make(self, numchars=30):
+        return FreebaseSeqFeedMaker(self.dp, self.gd, self.ed, numwords=10, numchars=numchars, cache=True)
+
+    def numcached(self):
+        return len([x for x in os.listdir(self.tmpdir) if x.endswith(".npy")])
+
+    def test_cached_same_as_parsed(self):
+        parsed = FreebaseSeqFeedMaker(self.dp, self.gd, self.ed, numwords=10, numchars=30)
+        first = self.make()
+        self.assertEqual(self.numcached(), 4)
+        second = self.make()
+        self.assertIsInstance(second.trainfeed, RaggedFeed)
+        self.assertIsInstance(second.trainfeed.data, np.memmap)
+        self.assertIsInstance(second.goldfeed, MemmapDataFeed)
+        self.assertLess(second.trainfeed.data.size, np.prod(parsed.trainfeed.shape) / 3)
+        for f in [first, second]:
+            self.assertTrue(np.all(f.trainfeed[:] == parsed.trainfeed[:]))
+            self.assertTrue(np.all(f.goldfeed[:] == parsed.goldfeed[:]))
+
+    def test_invalidation(self):
+        self.make()
+        self.make(numchars=20)
+        self.assertEqual(self.numcached(), 8)   # entries of different settings are kept
+        self.assertIsInstance(self.make().trainfeed.data, np.memmap)
+        self.assertIsInstance(self.make(numchars=20).trainfeed.data, np.memmap)
+        st = os.stat(self.dp)
+        os.utime(self.dp, (st.st_atime, st.st_mtime + 10))
+        f = self.make()
+        self.assertNotIsInstance(f.trainfeed.data, np.memmap)
+        self.assertEqual(self.numcached(), 8)   # the older version of these settings is removed
+        self.assertIsInstance(self.make().trainfeed.data, np.memmap)
+        self.assertNotIsInstance(self.make(numchars=20).trainfeed.data, np.memmap)
+        self.assertEqual(self.numcached(), 8)
+
+    def test_cachedir(self):
+        cachedir = os.path.join(self.tmpdir, "cache")
+        parsed = self.make()
+        f = FreebaseSeqFeedMaker(self.dp, self.gd, self.ed, numwords=10, numchars=30, cache=cachedir)
+        self.assertEqual(len(os.listdir(cachedir)), 4)
+        self.assertEqual(self.numcached(), 4)
+        f = FreebaseSeqFeedMaker(self.dp, self.gd, self.ed, numwords=10, numchars=30, cache=cachedir)
+        self.assertIsInstance(f.trainfeed.data, np.memmap)
+        self.assertTrue(np.all(f.trainfeed[:] == parsed.trainfeed[:]))
+
+
+class TestWordToWordId(TestCase):
+    def test_transform(self):
+        t = WordToWordId({"the": 2, "cat": 3}, numwords=4)
+        x = np.array([["The", "dog", None, "cat"], ["cat", "cats", None, None]], dtype="object")
+        expected = np.asarray([[2, 1, 0, 0], [3, 1, 0, 0]])    # unknown words ==> 1, skip after None
+        self.assertTrue(np.all(t.transform(x) == expected))
+        self.assertEqual(t.transform(x).dtype, np.dtype("int32"))
+        self.assertEqual(t.getshapefor(x.shape), (2, 4))
+
 
 class TestFreebaseSeqFeeder(TestCase):
     def test_fb_datafeed_shape(self):
@@ -1,11 +1,24 @@
 from unittest import TestCase
-from teafacto.blocks.memory import MemoryBlock
+from teafacto.blocks.memory import MemoryBlock, LinearGateMemAddr, DotMemAddr
+from teafacto.core.base import Val
 from teafacto.blocks.lang.wordembed import WordEmbedGlove
 from teafacto.blocks.lang.wordvec import Glove
 from teafacto.blocks.rnn import SeqEncoder
 from teafacto.blocks.rnu import GRU
-from teafacto.blocks.basic import IdxToOneHot
+from teafacto.blocks.basic import IdxToOneHot, VectorEmbed, Softmax
+from teafacto.core.base import Block
 import numpy as np
+import theano
+from theano import tensor
+
+
+class MemClassifier(Block):
+    def __init__(self, addr, **kw):
+        super(MemClassifier, self).__init__(**kw)
+        self.addr = addr
+
+    def apply(self, crit):
+        return Softmax()(self.addr(crit))
 
 
 class TestMemoryBlock(TestCase):
@@ -98,3 +111,144 @@ class TestMemoryBlock(TestCase):
         self.assertRaises(AssertionError, lambda: memb.predict(idxs, data))
 
 
+
+
+class TestCachedMemoryBlock(TestCase):
+    def setUp(self):
+        self.payload = VectorEmbed(indim=10, dim=7)
+        self.memb = MemoryBlock(self.payload, np.asarray([1, 2, 6, 9]), indim=4, outdim=7)
+        self.idxs = [0, 2, 3]
+        self.fresh = self.memb.predict(self.idxs)
+        self.cachedmemb = MemoryBlock.unfreeze(self.memb.freeze())
+        self.cachedmemb._predictf = None
+        self.cachedmemb.cached
+
+    def test_same_as_uncached(self):
+        self.assertTrue(np.allclose(self.fresh, self.cachedmemb.predict(self.idxs)))
+
+    def test_stale_until_refresh(self):
+        cachedpayload = self.cachedmemb.payload
+        cachedpayload.W.d.set_value(cachedpayload.W.d.get_value() + 1.)
+        self.assertTrue(np.allclose(self.fresh, self.cachedmemb.predict(self.idxs)))
+        self.cachedmemb.refresh()
+        self.assertTrue(np.allclose(self.fresh + 1., self.cachedmemb.predict(self.idxs)))
+
+    def test_no_payload_params(self):
+        self.cachedmemb.predict(self.idxs)
+        self.assertSetEqual(self.cachedmemb.output.allparams, set())
+
+
+class TestLinearGateMemAddr(TestCase):
+    chunksize = None
+
+    def setUp(self):
+        memsize, memdim, critdim, attdim = 23, 7, 5, 4
+        self.memval = np.random.random((memsize, memdim)).astype("float32")
+        self.critval = np.random.random((3, critdim)).astype("float32")
+        class Mem(object):      # only innervar is used for addressing
+            innervar = Val(self.memval)
+        self.addr = LinearGateMemAddr(Mem(), memdim=memdim, indim=critdim, attdim=attdim, chunksize=self.chunksize)
+
+    def test_values(self):
+        pred = self.addr.predict(self.critval)
+        W, U = self.addr.W.d.get_value(), self.addr.U.d.get_value()
+        expected = np.zeros((self.critval.shape[0], self.memval.shape[0]))
+        for i in range(self.memval.shape[0]):   # score each memory row as the concatenation [mem_i, crit]
+            combo = np.concatenate([np.repeat(self.memval[[i]], self.critval.shape[0], axis=0), self.critval], axis=1)
+            expected[:, i] = np.dot(np.tanh(np.dot(combo, W)), U)
+        self.assertEqual(pred.shape, expected.shape)
+        self.assertTrue(np.allclose(pred, expected, atol=1e-5))
+
+    def test_params(self):
+        self.addr.predict(self.critval)
+        self.assertSetEqual(self.addr.output.allparams, {self.addr.W, self.addr.U})
+
+
+class TestLinearGateMemAddrChunked(TestLinearGateMemAddr):
+    chunksize = 5
+
+
+class TestSampledMemAddr(TestCase):
+    def setUp(self):
+        self.memsize, self.dim = 20, 7
+        payload = VectorEmbed(indim=30, dim=self.dim)
+        self.memb = MemoryBlock(payload, np.arange(5, 5 + self.memsize), indim=self.memsize, outdim=self.dim)
+        self.critval = np.random.random((4, self.dim)).astype("float32")
+        self.gold = np.asarray([3, 3, 11, 17])
+        self.addr = self.getaddr()
+        self.full = self.addr.predict(self.critval)
+        self.addr._predictf = None
+
+    def getaddr(self):
+        return DotMemAddr(self.memb)
+
+    def test_sampled_scores(self):
+        numneg = 5
+        self.addr.sampled(numneg).sample(self.gold)
+        pred = self.addr.predict(self.critval)
+        cands = self.addr._cands.d.get_value()
+        self.assertTrue(set(self.gold).issubset(set(cands)))
+        self.assertLessEqual(len(cands), len(set(self.gold)) + numneg)
+        self.assertEqual(pred.shape, (self.critval.shape[0], len(cands)))    # scores of the candidates only
+        expected = self.full[:, cands] - np.log(numneg * 1. / self.memsize)
+        self.assertTrue(np.allclose(pred, expected, atol=1e-5))
+
+    def test_goldpos(self):
+        self.addr.sampled(5).sample(self.gold)
+        gold = tensor.lvector()
+        goldpos = theano.function([gold], self.addr.goldpos(gold))(self.gold)
+        self.assertTrue(np.all(self.addr._cands.d.get_value()[goldpos] == self.gold))
+
+    def test_frequency_sampling(self):
+        freqs = np.zeros((self.memsize,))
+        freqs[[0, 1]] = [1, 3]
+        self.addr.sampled(8, freqs=freqs).sample(self.gold)
+        cands = self.addr._cands.d.get_value()
+        self.assertEqual(set(cands), set(self.gold).union({0, 1}))
+        pred = self.addr.predict(self.critval)
+        self.assertTrue(np.allclose(pred[:, list(cands).index(1)], self.full[:, 1] - np.log(8 * .75), atol=1e-5))
+
+    def test_full_after_sampled(self):
+        self.addr.sampled(5).full
+        self.assertTrue(np.allclose(self.addr.predict(self.critval), self.full))
+        self.assertTrue(self.addr.sampled().issampled)
+
+    def test_full_after_training_without_validation(self):
+        model = MemClassifier(self.addr.sampled(5))
+        crits = np.random.random((40, self.dim)).astype("float32")
+        gold = np.random.randint(0, self.memsize, (40,))
+        model.train([crits], gold).adadelta(lr=0.1).cross_entropy().sampled(self.addr).train(numbats=3, epochs=1)
+        self.assertFalse(self.addr.issampled)
+        self.assertEqual(model.predict(crits).shape, (40, self.memsize))
+
+    def test_trainer_validates_on_full_memory(self):
+        model = MemClassifier(self.addr.sampled(5))
+        crits = np.random.random((40, self.dim)).astype("float32")
+        gold = np.random.randint(0, self.memsize, (40,))
+        samples = []
+        sample = self.addr.sample
+        self.addr.sample = lambda g, **kw: samples.append(g) or sample(g, **kw)
+        trainer = model.train([crits], gold).adadelta(lr=0.1).cross_entropy() \
+            .split_validate(4, random=False).cross_entropy().sampled(self.addr)
+        trainer.train(numbats=3, epochs=2)
+        self.assertEqual(len(samples), 2 * 3)     # training batches only
+        probs = model.predict(crits)    # full addressing after training
+        self.assertEqual(probs.shape, (40, self.memsize))
+        trainf = trainer.buildtrainfun(model)
+        validf = trainer.buildvalidfun(model)
+        self.assertTrue(np.allclose(model.predict(crits), probs))
+        expected = -np.mean(np.log(probs[np.arange(40), gold]))
+        self.assertTrue(np.allclose(validf(crits, gold)[0], expected, atol=1e-4))
+        sample(gold)
+        self.addr.sampled()
+        self.addr._predictf = None
+        scores = self.addr.predict(crits)     # (40, numcands)
+        cands = list(self.addr._cands.d.get_value())
+        sprobs = np.exp(scores) / np.sum(np.exp(scores), axis=1, keepdims=True)
+        expected = -np.mean(np.log(sprobs[np.arange(40), [cands.index(g) for g in gold]]))
+        self.assertTrue(np.allclose(trainf(crits, gold)[0], expected, atol=1e-4))
+
+
+class TestSampledLinearGateMemAddr(TestSampledMemAddr):
+    def getaddr(self):
+        return LinearGateMemAddr(self.memb, memdim=self.dim, indim=self.dim, attdim=6, chunksize=3)
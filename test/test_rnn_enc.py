@@ -2,8 +2,10 @@ from unittest import TestCase
 
 from teafacto.blocks.rnn import SeqEncoder
 from teafacto.blocks.rnu import GRU
+from teafacto.blocks.basic import IdxToOneHot
 import numpy as np
 from teafacto.util import issequence
+from teafacto.core.datafeed import DataFeeder
 
 
 class SimpleRNNEncoderTest(TestCase):
@@ -96,3 +98,39 @@ class StackRNNEncoderTestAllStatesWithOutputs(StackRNNEncoderTest):
         return enc.all_states.with_outputs
 
 
+class SimpleRNNEncoderTestPrecompute(SimpleRNNEncoderTest):
+    def doswitches(self, enc):
+        return enc.precompute
+
+
+class StackRNNEncoderTestPrecompute(StackRNNEncoderTest):
+    def doswitches(self, enc):
+        return enc.precompute
+
+
+class EmbedRNNEncoderPrecomputeTest(TestCase):
+    def test_same_as_plain(self):
+        vocsize = 23
+        encdim = 17
+        gru = GRU(dim=vocsize, innerdim=encdim)
+        data = np.random.randint(0, vocsize, (100, 7)).astype("int32")
+        data[:, -2:] = 0    # masked
+        plainpred = SeqEncoder(IdxToOneHot(vocsize), gru).predict(data)
+        precpred = SeqEncoder(IdxToOneHot(vocsize), gru).precompute.predict(data)
+        self.assertTrue(np.allclose(plainpred, precpred))
+
+
+class BucketedRNNEncoderTest(TestCase):
+    def test_trimmed_batches_same_as_padded(self):
+        dim, encdim = 13, 17
+        lens = np.random.randint(1, 6, (100,))
+        data = np.zeros((100, 20, dim), dtype="float32")
+        for i, l in enumerate(lens):
+            data[i, :l] = np.random.random((l, dim))
+        enc = SeqEncoder(GRU(dim=dim, innerdim=encdim))
+        padpred = enc.predict(data)
+        df = DataFeeder(data, np.arange(0, 100)).numbats(5).bucketed(0)
+        while df.hasnextbatch():
+            batch, idxs = df.nextbatch()
+            self.assertLess(batch.shape[1], 6)
+            self.assertTrue(np.allclose(enc.predict(batch), padpred[idxs], atol=1e-6))
@@ -3,6 +3,8 @@ from unittest import TestCase
 from teafacto.blocks.rnu import *
 from teafacto.core.stack import *
 from teafacto.examples.dummy import *
+from teafacto.blocks.basic import MatDot as Lin
+from teafacto.blocks.rnn import RecurrentStack
 
 
 class TestRecurrentStack(TestCase):
@@ -33,3 +35,18 @@ class TestBlockStack(TestCase):
     def test_param_propagation(self):
         self.assertSetEqual(set(self.out.allparams), {self.O, self.W.W})
 
+
+
+class TestRecurrentStackTimeDistributed(TestCase):
+    def test_same_as_stepwise(self):
+        vocsize, embdim, innerdim, outdim = 20, 11, 13, 7
+        emb = VectorEmbed(indim=vocsize, dim=embdim)
+        gru = GRU(dim=embdim, innerdim=innerdim)
+        lin = Lin(indim=innerdim, dim=outdim)
+        steplin = Lin(indim=innerdim, dim=outdim)
+        steplin.W.value.set_value(lin.W.value.get_value())
+        data = np.random.randint(0, vocsize, (15, 6)).astype("int32")
+        distpred = RecurrentStack(emb, gru, lin, Softmax()).predict(data)
+        steppred = RecurrentStack(emb.stepwise, gru, steplin.stepwise, Softmax().stepwise).predict(data)
+        self.assertEqual(distpred.shape, (15, 6, outdim))
+        self.assertTrue(np.allclose(distpred, steppred))
@@ -1,9 +1,12 @@
 from unittest import TestCase
 
-import numpy as np
+import numpy as np, os, json, shutil, tempfile
 
 from teafacto.examples.dummy import *
-from teafacto.core.trainer import ModelTrainer
+from teafacto.core.trainer import ModelTrainer, DynamicLearningParam
+from teafacto.blocks.rnn import SeqEncoder
+from teafacto.blocks.rnu import GRU
+from teafacto.core.checkpoint import savecheckpoint, loadcheckpoint, CheckpointWriter
 
 '''
     pred = ae.predict(pdata)
@@ -128,6 +131,323 @@ class TestModelTrainerAutovalidate(TestModelTrainerNovalidate):
 
 
 
+class TestBatchHook(TestCase):
+    def test_hook_called_every_inter_batches(self):
+        self.vocabsize = 200
+        ae = Dummy(indim=self.vocabsize, dim=10)
+        data = np.arange(0, self.vocabsize).astype("int32")
+        calls = []
+        ae.train([data], data).adadelta(lr=0.1).cross_entropy() \
+            .batchhook(lambda: calls.append(None), inter=3) \
+            .autovalidate().cross_entropy() \
+            .train(numbats=10, epochs=2)
+        self.assertEqual(len(calls), 20 // 3)     # only training batches are counted
+
+    def test_feedhook_gets_every_batch(self):
+        self.vocabsize = 200
+        ae = Dummy(indim=self.vocabsize, dim=10)
+        data = np.arange(0, self.vocabsize).astype("int32")
+        batches = []
+        ae.train([data], data).adadelta(lr=0.1).cross_entropy() \
+            .feedhook(lambda *batch: batches.append(batch)) \
+            .train(numbats=10, epochs=2)
+        self.assertEqual(len(batches), 20)
+        self.assertTrue(all([len(batch) == 2 for batch in batches]))      # input and gold
+
+
+class TrainCopyTest(TestCase):
+    '''
+    Trains copies of the same Dummy on the same batches, with the trainer settings of settings().
+    '''
+    def setUp(self):
+        self.vocabsize = 200
+        self.ae = Dummy(indim=self.vocabsize, dim=10)
+        self.data = np.arange(0, self.vocabsize).astype("int32")
+
+    def settings(self, trainer, **kw):
+        return trainer.adadelta(lr=0.5).cross_entropy()
+
+    def traincopy(self, epochs=2, data=None, **kw):     # returns the trained copy and its training errors
+        data = self.data if data is None else data
+        ae = Dummy.unfreeze(self.ae.freeze())
+        self.trainer = self.settings(ae.train([data], data), **kw)
+        np.random.seed(1337)
+        _, err, _, _, _ = self.trainer.train(numbats=10, epochs=epochs, returnerrors=True)
+        return ae, err
+
+
+class TestSparseUpdates(TrainCopyTest):     # dense updates would normalize untouched rows too
+    def settings(self, trainer, optimizer=None, sparse=True):
+        trainer = optimizer(trainer).cross_entropy()
+        if not sparse:
+            trainer.sparseoptimizer = None
+        return trainer
+
+    def test_embedding_is_sparse(self):
+        trainer = self.ae.train([self.data], self.data).adagrad().cross_entropy()
+        trainer.buildtrainfun(self.ae)
+        cost = trainer.buildlosses(self.ae, [trainer.objective])[0][0]
+        sparse = trainer._rowindexed(cost, self.ae.output.allparams)
+        self.assertEqual(sparse.keys(), [self.ae.W.W])
+
+    def test_sgd_same_as_dense(self):
+        self.assertSameAsDense(lambda t: t.sgd(lr=0.5))
+
+    def test_adagrad_same_as_dense(self):
+        self.assertSameAsDense(lambda t: t.adagrad(lr=0.5))
+
+    def assertSameAsDense(self, optimizer):
+        sparse, _ = self.traincopy(optimizer=optimizer)
+        dense, _ = self.traincopy(optimizer=optimizer, sparse=False)
+        self.assertTrue(np.allclose(sparse.W.W.d.get_value(), dense.W.W.d.get_value(), atol=1e-5))
+        self.assertTrue(np.allclose(sparse.O.d.get_value(), dense.O.d.get_value(), atol=1e-5))
+
+    def test_adam_untouched_rows_unchanged(self):
+        data = self.data[:100]
+        trained, _ = self.traincopy(optimizer=lambda t: t.adam(lr=0.1), data=data)
+        before, after = self.ae.W.W.d.get_value(), trained.W.W.d.get_value()
+        self.assertTrue(np.allclose(before[100:], after[100:]))
+        self.assertFalse(np.allclose(before[:100], after[:100]))
+
+
+class SeqClassifier(Block):
+    def __init__(self, vocsize=50, numclasses=6, **kw):
+        super(SeqClassifier, self).__init__(**kw)
+        self.emb = VectorEmbed(indim=vocsize, dim=8)
+        self.enc = SeqEncoder(self.emb, GRU(dim=8, innerdim=numclasses))
+
+    def apply(self, seq):
+        return Softmax()(self.enc(seq))
+
+
+class TestSparseUpdatesInScan(TestCase):
+    def setUp(self):
+        self.data = np.random.randint(1, 50, (40, 5)).astype("int32")
+        self.gold = np.random.randint(0, 6, (40,)).astype("int32")
+
+    def traincopy(self, sparse=True):
+        np.random.seed(1337)
+        model = SeqClassifier()
+        trainer = model.train([self.data], self.gold).adagrad(lr=0.5).cross_entropy()
+        if not sparse:
+            trainer.sparseoptimizer = None
+        trainer.train(numbats=4, epochs=2)
+        return model
+
+    def test_embedding_in_scan_is_sparse(self):
+        model = SeqClassifier()
+        trainer = model.train([self.data], self.gold).adagrad().cross_entropy()
+        cost = trainer.buildlosses(model, [trainer.objective])[0][0]
+        self.assertEqual(trainer._rowindexed(cost, model.output.allparams).keys(), [])
+        cost = trainer._hoistlookups(cost, model.output.allparams)
+        self.assertEqual(trainer._rowindexed(cost, model.output.allparams).keys(), [model.emb.W])
+
+    def test_same_as_dense(self):
+        sparse, dense = self.traincopy(), self.traincopy(sparse=False)
+        for name, param in sparse.namedparams.items():
+            self.assertTrue(np.allclose(param.d.get_value(), dense.namedparams[name].d.get_value(), atol=1e-5))
+
+
+class TestFrozenParams(TestCase):
+    def test_no_gradient_or_optimizer_state(self):
+        vocabsize = 200
+        data = np.arange(0, vocabsize).astype("int32")
+        ae = Dummy(indim=vocabsize, dim=10)
+        ae.W.W.lrmul = 0.
+        before = Dummy.unfreeze(ae.freeze())
+        trainer = ae.train([data], data).adam(lr=0.1).cross_entropy()
+        trainf = trainer.buildtrainfun(ae)
+        self.assertEqual(trainer._optimstate.keys(), [ae.O])
+        updated = [inp.variable for inp in trainf.maker.inputs if inp.update is not None]
+        self.assertFalse(any([var is ae.W.W.d for var in updated]))
+        trainer.train(numbats=10, epochs=2)
+        self.assertTrue(np.allclose(ae.W.W.d.get_value(), before.W.W.d.get_value()))
+        self.assertFalse(np.allclose(ae.O.d.get_value(), before.O.d.get_value()))
+
+
+class TestInGraphBatches(TrainCopyTest):
+    def settings(self, trainer, ingraph=None):
+        trainer = super(TestInGraphBatches, self).settings(trainer)
+        return trainer.ingraph(batchespercall=ingraph) if ingraph is not None else trainer
+
+    def test_same_as_fed(self):
+        fed, fed_err = self.traincopy()
+        ingraph, ingraph_err = self.traincopy(ingraph=1)
+        self.assertTrue(np.allclose(fed.O.d.get_value(), ingraph.O.d.get_value(), atol=1e-5))
+        self.assertTrue(np.allclose(fed_err, ingraph_err))
+
+    def test_multiple_batches_per_call_same_as_fed(self):
+        fed, _ = self.traincopy()
+        ingraph, _ = self.traincopy(ingraph=3)
+        self.assertTrue(np.allclose(fed.O.d.get_value(), ingraph.O.d.get_value(), atol=1e-5))
+        self.assertTrue(np.allclose(fed.W.W.d.get_value(), ingraph.W.W.d.get_value(), atol=1e-5))
+
+    def test_bucketed_not_supported(self):     # batches are gathered in-graph, they can not be trimmed
+        trainer = self.ae.train([self.data], self.data).adadelta(lr=0.5).cross_entropy().ingraph().bucketed()
+        self.assertRaises(AssertionError, trainer.train, numbats=10, epochs=1)
+
+
+class TestTakeBest(TrainCopyTest):
+    def test_restores_best_params_in_place(self):
+        def nofreeze():
+            raise AssertionError("model should not be frozen")
+        expected, _ = self.traincopy(2)
+        ae = Dummy.unfreeze(self.ae.freeze())
+        ae.freeze = nofreeze
+        trainer = ae.train([self.data], self.data).adadelta(lr=0.5).cross_entropy() \
+            .takebest(lambda x: 0 if x[-1] == 3 else 1)     # after the second epoch
+        np.random.seed(1337)
+        trained = trainer.train(numbats=10, epochs=4)
+        self.assertIs(trained, ae)
+        self.assertTrue(np.allclose(ae.O.d.get_value(), expected.O.d.get_value()))
+        self.assertTrue(np.allclose(ae.W.W.d.get_value(), expected.W.W.d.get_value()))
+        self.assertTrue(np.allclose(ae.predict(self.data), expected.predict(self.data)))
+
+    def test_reuses_buffers(self):
+        ae, _ = self.traincopy(1)
+        snapshots = []
+        trainer = ae.train([self.data], self.data).adadelta(lr=0.5).cross_entropy() \
+            .takebest(lambda x: -x[-1]).batchhook(lambda: snapshots.append(trainer.bestmodel[0]), inter=10)
+        trainer.train(numbats=10, epochs=3)
+        self.assertIs(snapshots[1], snapshots[2])
+
+    def test_frozen_params_not_snapshotted(self):
+        self.ae.W.W.lrmul = 0.
+        ae, _ = self.traincopy(1)
+        trainer = ae.train([self.data], self.data).adadelta(lr=0.5).cross_entropy().takebest(lambda x: -x[-1])
+        trainer.train(numbats=10, epochs=2)
+        self.assertEqual(len(trainer.bestmodel[0].params), 1)
+        self.assertIs(trainer.bestmodel[0].params[0], ae.O)
+
+
+class HalvingLR(DynamicLearningParam):
+    def __call__(self, lr, epoch, maxiter, terrs, verrs):
+        return self.lr * 0.5 ** (epoch - 1)
+
+
+class TestCheckpoint(TestCase):
+    def setUp(self):
+        self.vocabsize = 200
+        self.ae = Dummy(indim=self.vocabsize, dim=10)
+        self.data = np.arange(0, self.vocabsize).astype("int32")
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, "dummy.ckpt")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def trainer(self, ae):
+        return ae.train([self.data], self.data).adam(lr=HalvingLR(0.01)).cross_entropy()
+
+    def test_save_load(self):
+        savecheckpoint(self.path, self.ae)
+        self.assertEqual(sorted(os.listdir(os.path.join(self.path, "params"))), ["O.npy", "W.W.npy"])
+        other = Dummy(indim=self.vocabsize, dim=10)
+        self.assertFalse(np.allclose(other.predict(self.data), self.ae.predict(self.data)))
+        loadcheckpoint(self.path, other)
+        self.assertTrue(np.allclose(other.predict(self.data), self.ae.predict(self.data)))
+        self.assertRaises(Exception, loadcheckpoint, self.path, Dummy(indim=self.vocabsize + 1, dim=10))
+
+    def test_block_methods(self):   # same format as the checkpoints written by the trainer
+        self.trainer(self.ae).autosave.saveto(self.path).train(numbats=1, epochs=1)
+        other = Dummy(indim=self.vocabsize, dim=10)
+        self.assertEqual(other.loadcheckpoint(self.path)["epoch"], 1)
+        self.assertTrue(np.allclose(other.predict(self.data), self.ae.predict(self.data)))
+        path = os.path.join(self.path, "other")
+        self.assertEqual(other.savecheckpoint(path), path)
+        self.assertTrue(np.allclose(np.load(os.path.join(path, "params", "O.npy")), self.ae.O.d.get_value()))
+
+    def test_resume_same_as_uninterrupted(self):
+        uninterrupted = Dummy.unfreeze(self.ae.freeze())
+        self.trainer(uninterrupted).train(numbats=1, epochs=4)
+        first = Dummy.unfreeze(self.ae.freeze())
+        self.trainer(first).autosave.saveto(self.path).train(numbats=1, epochs=2)
+        with open(os.path.join(self.path, "manifest.json")) as f:
+            manifest = json.load(f)
+        self.assertEqual(manifest["config"]["epoch"], 2)
+        self.assertEqual(len(os.listdir(os.path.join(self.path, "optim"))), 2 * 3)  # adam: moments and t per param
+        resumed = Dummy(indim=self.vocabsize, dim=10)
+        trainer = self.trainer(resumed).resume(self.path).autosave.saveto(self.path)
+        trainer.train(numbats=1, epochs=4)     # epochs 3 and 4
+        self.assertEqual(trainer.currentiter, 5)
+        for param in ["O", "W.W"]:
+            self.assertTrue(np.allclose(resumed.namedparams[param].d.get_value(),
+                                        uninterrupted.namedparams[param].d.get_value(), atol=1e-6))
+        with open(os.path.join(self.path, "manifest.json")) as f:
+            self.assertEqual(json.load(f)["config"]["epoch"], 4)
+
+    def test_writer_keeps_latest(self):
+        writer = CheckpointWriter()
+        for i in range(5):
+            self.ae.O.d.set_value(np.ones_like(self.ae.O.d.get_value()) * i)
+            writer.save(self.path, self.ae, config={"i": i})
+        writer.close()
+        other = Dummy(indim=self.vocabsize, dim=10)
+        self.assertEqual(loadcheckpoint(self.path, other), {"i": 4})
+        self.assertTrue(np.all(other.O.d.get_value() == 4))
+        self.assertFalse(os.path.exists(self.path + ".tmp"))
+
+
+class TestPrefetch(TrainCopyTest):
+    def settings(self, trainer, prefetch=None):
+        trainer = super(TestPrefetch, self).settings(trainer).autovalidate().cross_entropy()
+        return trainer.prefetch(prefetch) if prefetch is not None else trainer
+
+    def test_same_as_fed(self):
+        fed, fed_err = self.traincopy()
+        prefetched, prefetched_err = self.traincopy(prefetch=3)
+        self.assertEqual(len(self.trainer._prefetchers), 0)      # threads closed after training
+        self.assertTrue(np.allclose(fed.O.d.get_value(), prefetched.O.d.get_value()))
+        self.assertTrue(np.allclose(fed_err, prefetched_err))
+
+
+class TestBucketing(TestCase):
+    def test_trains_on_trimmed_batches(self):
+        vocabsize = 20
+        from teafacto.blocks.rnn import SeqEncoder
+        from teafacto.blocks.rnu import GRU
+        class SeqDummy(Block):
+            def __init__(self, **kw):
+                super(SeqDummy, self).__init__(**kw)
+                self.enc = SeqEncoder(VectorEmbed(indim=vocabsize, dim=10), GRU(dim=10, innerdim=vocabsize))
+            def apply(self, seq):
+                return Softmax()(self.enc(seq))
+        data = np.zeros((100, 15), dtype="int32")
+        for i in range(data.shape[0]):
+            data[i, :np.random.randint(1, 5)] = np.random.randint(1, vocabsize)
+        gold = data[:, 0]
+        seqlens = []
+        SeqDummy().train([data], gold).adadelta(lr=0.5).cross_entropy().autovalidate().cross_entropy() \
+            .bucketed(0).feedhook(lambda seq, gold: seqlens.append(seq.shape[1])) \
+            .train(numbats=5, epochs=2)
+        self.assertEqual(len(seqlens), 2 * (5 + 1))     # training batches and one validation batch per epoch
+        self.assertTrue(all([seqlen < 5 for seqlen in seqlens]))
+
+
+class TestNegativeSampling(TestCase):
+    def test_margin_training(self):
+        from teafacto.core.datafeed import CorruptedFeed
+        vocabsize = 50
+        class MarginDummy(Block):
+            def __init__(self, **kw):
+                super(MarginDummy, self).__init__(**kw)
+                self.W = VectorEmbed(indim=vocabsize, dim=5)
+                self.v = param((5,), name="v").uniform()
+            def apply(self, pos, neg):     # pos: (batsize,), neg: (batsize, negrate)
+                posscore = T.dot(self.W(pos), self.v)
+                negscore = T.dot(self.W(neg), self.v)
+                return T.sum(T.maximum(0, 1. - posscore.dimshuffle(0, "x") + negscore), axis=1)
+        data = np.random.randint(0, 10, (200,)).astype("int32")    # positives are the first ten ids
+        negs = CorruptedFeed(data, numids=vocabsize, negrate=3)
+        batches = []
+        _, err, _, _, _ = MarginDummy().train([data, negs], np.ones((200,), dtype="float32")).adadelta(lr=1.) \
+            .linear_objective().feedhook(lambda pos, neg, gold: batches.append(neg)) \
+            .train(numbats=4, epochs=5, returnerrors=True)
+        self.assertEqual(len(batches), 20)
+        self.assertEqual(batches[0].shape, (50, 3))
+        self.assertLess(err[-1], err[0])
+
+
 class TestObjectives(TestCase):
     pass
 